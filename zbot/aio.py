@@ -0,0 +1,291 @@
+# ZBOT - 24/7 channel daemon
+#
+#
+
+import asyncio
+import collections
+import concurrent.futures
+import inspect
+import time
+import zbot.obj
+
+from zbot.obj import get
+from zbot.hdl import Kernel, get_exception, get_kernel, launch, pool
+from zbot.irc import DCC, IRC, TextWrap
+
+def __dir__():
+    return ("DCC", "IRC", "Kernel", "Queue", "inloop")
+
+class Queue:
+
+    __slots__ = ("loop", "queue")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    async def get(self):
+        return await self.queue.get()
+
+    def put(self, event):
+        if inloop(self.loop):
+            self.queue.put_nowait(event)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    put_nowait = put
+
+class Kernel(Kernel):
+
+    def __init__(self):
+        super().__init__()
+        self.loop = asyncio.new_event_loop()
+        self.queue = Queue(self.loop)
+        self.sems = {}
+        self.tasks = set()
+
+    async def adispatch(self, e):
+        e.parse()
+        func = get(self.cmds, e.cmd)
+        if func:
+            sem = self.asemaphore(e.cmd, func)
+            start = time.time()
+            try:
+                if sem:
+                    await sem.acquire()
+                if inspect.iscoroutinefunction(func):
+                    await func(e)
+                else:
+                    await self.loop.run_in_executor(None, func, e)
+            except Exception as ex:
+                print(get_exception())
+            finally:
+                if sem:
+                    sem.release()
+                self.measure(e.cmd, start - (e.queued or start), time.time() - start)
+        e.show()
+        e.ready.set()
+
+    def asemaphore(self, cmd, func):
+        nr = getattr(func, "limit", None)
+        if not nr:
+            return None
+        if cmd not in self.sems:
+            self.sems[cmd] = asyncio.BoundedSemaphore(nr)
+        return self.sems[cmd]
+
+    async def drain(self, key):
+        while self.pending[key]:
+            await self.adispatch(self.pending[key].popleft())
+        del self.pending[key]
+
+    async def handler(self):
+        while not self.stopped:
+            event = await self.queue.get()
+            if not event:
+                break
+            if not event.orig:
+                event.orig = repr(self)
+            if not event.txt:
+                event.ready.set()
+                continue
+            event.queued = time.time()
+            key = event.origin or event.orig
+            if key in self.pending:
+                self.pending[key].append(event)
+                continue
+            self.pending[key] = collections.deque([event])
+            self.spawn(self.drain(key))
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(pool.workers, "aio"))
+        try:
+            self.loop.run_until_complete(self.handler())
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+
+    def schedule(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def start(self):
+        assert zbot.obj.workdir
+        self.init(self.cfg.mods)
+        if self.cfg.compact:
+            self.init("cmd")
+        launch(self.run, pool=False, name="aio")
+
+class DCC(DCC):
+
+    def __init__(self):
+        super().__init__()
+        self.loop = get_kernel().loop
+        self.writer = None
+
+    def raw(self, txt):
+        data = bytes(str(txt).rstrip() + "\n", self.encoding)
+        if inloop(self.loop):
+            self.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.write, data)
+
+    async def session(self, event):
+        k = get_kernel()
+        arguments = event.txt.split()
+        try:
+            reader, self.writer = await asyncio.open_connection(arguments[3], int(arguments[4]))
+        except (IndexError, OSError, ValueError):
+            self.stop()
+            return
+        self.origin = event.origin
+        self.raw("Welcome to ZBOT %s !!" % event.nick)
+        self._connected.set()
+        while not self.stopped:
+            try:
+                txt = await reader.readline()
+            except OSError:
+                break
+            if not txt:
+                break
+            k.queue.put(self.event(str(txt, self.encoding, "replace")))
+        self.stop()
+
+    def stop(self):
+        super().stop()
+        if self.writer:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    def write(self, data):
+        if self.writer and not self.writer.is_closing():
+            self.writer.write(data)
+
+class IRC(IRC):
+
+    def __init__(self):
+        super().__init__()
+        self._outqueue = asyncio.Queue()
+        self.loop = get_kernel().loop
+        self.lookups = concurrent.futures.ThreadPoolExecutor(1, "lookups")
+        self.writer = None
+
+    def chat(self, event):
+        dcc = DCC()
+        dcc.encoding = "utf-8"
+        get_kernel().schedule(dcc.session(event))
+
+    def doconnect(self):
+        assert self.cfg.server
+        assert self.cfg.nick
+        get_kernel().schedule(self.session())
+
+    async def input(self, reader):
+        while not self.stopped:
+            try:
+                txt = await reader.readline()
+            except OSError as ex:
+                self.state.nrerror += 1
+                self.state.error = str(ex)
+                print(self.state.error)
+                break
+            if not txt:
+                break
+            self._buffer.append(str(txt, "utf-8", "replace").rstrip("\r\n"))
+            try:
+                self.dispatch(self.poll())
+            except Exception as ex:
+                print(get_exception())
+
+    async def output(self):
+        wrapper = TextWrap()
+        while not self.stopped:
+            channel, txt = await self._outqueue.get()
+            if channel is None:
+                break
+            for t in wrapper.wrap(str(txt).replace("\n", "")):
+                self.command("PRIVMSG", channel, t)
+                if (time.time() - self.state.last) < 4.0:
+                    await asyncio.sleep(4.0)
+                self.state.last = time.time()
+
+    def raw(self, txt):
+        txt = txt.rstrip()
+        if not txt.endswith("\r\n"):
+            txt += "\r\n"
+        data = bytes(txt[:512], "utf-8")
+        if inloop(self.loop):
+            self.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.write, data)
+
+    def reconfig(self, cfg):
+        if inloop(self.loop):
+            super().reconfig(cfg)
+        else:
+            self.loop.call_soon_threadsafe(super().reconfig, cfg)
+
+    def say(self, channel, txt):
+        if inloop(self.loop):
+            self._outqueue.put_nowait((channel, txt))
+        else:
+            self.loop.call_soon_threadsafe(self._outqueue.put_nowait, (channel, txt))
+
+    async def session(self):
+        k = get_kernel()
+        out = k.spawn(self.output())
+        while not self.stopped:
+            self.state.nrconnect += 1
+            try:
+                reader, self.writer = await asyncio.open_connection(self.cfg.server, int(self.cfg.port or 6667))
+            except OSError as ex:
+                self.state.nrerror += 1
+                self.state.error = str(ex)
+                await asyncio.sleep(10.0)
+                continue
+            self._connected.set()
+            self.logon(self.cfg.server, self.cfg.nick)
+            await self.input(reader)
+            self._connected.clear()
+            self.writer.close()
+            if not self.stopped:
+                await asyncio.sleep(10.0)
+        out.cancel()
+
+    def stop(self):
+        self.stopped = True
+        self.queue.put(None)
+        self.detach()
+        self.say(None, None)
+        if self.writer:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    def write(self, data):
+        if not self.writer or self.writer.is_closing():
+            return
+        self.writer.write(data)
+        self.state.last = time.time()
+        self.state.nrsend += 1
+
+    def ERROR(self, event):
+        self.state.nrerror += 1
+        self.state.error = event.error
+        print(event.error)
+        if self.writer:
+            self.writer.close()
+
+    def PRIVMSG(self, event):
+        if self.cfg.users and inloop(self.loop):
+            self.loop.run_in_executor(self.lookups, self.PRIVMSG, event)
+            return
+        super().PRIVMSG(event)
+
+def inloop(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
@@ -0,0 +1,332 @@
+# ZBOT - 24/7 channel daemon
+#
+#
+
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zbot.obj
+
+from zbot.obj import Cfg, Default, Object, add_index, find, get_type, grep, last, names, save, set_engine, stamp, unstamp, update
+from zbot.csl import parse
+
+def __dir__():
+    return ("Log", "Setting", "Person", "backends", "compare", "generate", "lines", "main", "mix", "run", "wide")
+
+class Log(Object):
+
+    def __init__(self):
+        super().__init__()
+        self.channel = ""
+        self.nick = ""
+        self.txt = ""
+
+class Person(Object):
+
+    def __init__(self):
+        super().__init__()
+        self.perms = []
+        self.user = ""
+
+class Setting(Cfg):
+
+    pass
+
+results = {}
+scenarios = []
+
+def bench(name, ops=1):
+    def benchdec(func):
+        def benchfunc(cfg):
+            start = time.perf_counter()
+            nr = func(cfg) or ops
+            secs = time.perf_counter() - start
+            results[name] = {"ops": nr, "seconds": round(secs, 6), "rate": round(nr / secs, 2) if secs else 0}
+            return results[name]
+        scenarios.append((name, benchfunc))
+        return benchfunc
+    return benchdec
+
+def backends(cfg):
+    stores = (cfg.stores or "files,segment,sqlite").split(",")
+    res = {}
+    for store in stores:
+        c = Default()
+        update(c, cfg)
+        c.store = store
+        c.wd = ""
+        res[store] = run(c)["results"]
+    lines = ["%-16s" % "scenario" + "".join(["%13s" % x for x in stores])]
+    for name in sorted(res[stores[0]]):
+        lines.append("%-16s" % name + "".join(["%12.6fs" % res[x][name]["seconds"] for x in stores]))
+    return lines
+
+def cold():
+    zbot.obj.cache.clear()
+    zbot.obj.indexes.clear()
+
+def ircparser():
+    from zbot.irc import IRC
+    from zbot.hdl import bus
+    i = IRC()
+    bus.remove(i)
+    return i
+
+def lines(nr, seed=1):
+    rnd = random.Random(seed)
+    res = []
+    for x in range(nr):
+        nick = "nick%s" % rnd.randint(0, 999)
+        txt = " ".join(["word%s" % rnd.randint(0, 5000) for _x in range(rnd.randint(3, 15))])
+        res.append(":%s!~%s@host%s PRIVMSG #chan%s :%s" % (nick, nick, x % 97, x % 10, txt))
+    return res
+
+def compare(old, new):
+    with open(old, "r") as ofile:
+        o = json.load(ofile)
+    with open(new, "r") as nfile:
+        n = json.load(nfile)
+    res = ["%-16s %13s %13s %9s" % ("scenario", "old", "new", "speedup")]
+    for name, v in sorted(n["results"].items()):
+        if name not in o["results"]:
+            continue
+        ov = o["results"][name]
+        ratio = ov["seconds"] / v["seconds"] if v["seconds"] else 0
+        res.append("%-16s %12.6fs %12.6fs %8.2fx" % (name, ov["seconds"], v["seconds"], ratio))
+        if "bytes" in v and "bytes" in ov:
+            ratio = ov["bytes"] / v["bytes"] if v["bytes"] else 0
+            res.append("%-16s %12.1fb %12.1fb %8.2fx" % (name, ov["bytes"], v["bytes"], ratio))
+    return res
+
+def generate(cfg):
+    kinds = {"log": Log, "person": Person, "setting": Setting}
+    types = []
+    for name, weight in mix(cfg):
+        types.extend([kinds[name]] * weight)
+    rnd = random.Random(int(cfg.seed or 1))
+    size = int(cfg.size or 10000)
+    span = float(cfg.days or 30) * 24 * 60 * 60
+    start = time.time() - span
+    for nr in range(size):
+        cls = rnd.choice(types)
+        o = cls()
+        if cls is Log:
+            o.channel = "#chan%s" % rnd.randint(0, 9)
+            o.nick = "nick%s" % rnd.randint(0, 999)
+            o.txt = " ".join(["word%s" % rnd.randint(0, 5000) for _x in range(rnd.randint(3, 15))])
+        elif cls is Person:
+            o.user = "nick%s!~user@host%s" % (nr, nr % 97)
+            o.perms = ["USER"]
+        else:
+            o.nr = nr
+        stime = datetime.datetime.fromtimestamp(start + span * nr / size)
+        save(o, str(stime).split(".")[0].replace(" ", os.sep))
+    return size
+
+def mix(cfg):
+    res = []
+    for item in (cfg.mix or "log:8,person:1,setting:1").split(","):
+        name, _sep, weight = item.partition(":")
+        res.append((name.strip().lower(), int(weight or 1)))
+    return res
+
+@bench("names")
+def _names(cfg):
+    cold()
+    return len(names(get_type(Log)))
+
+@bench("find_cold")
+def _find_cold(cfg):
+    cold()
+    return len(list(find(get_type(Person))))
+
+@bench("find_warm")
+def _find_warm(cfg):
+    return len(list(find(get_type(Person))))
+
+@bench("select_scan")
+def _select_scan(cfg):
+    return len(list(find(get_type(Log), {"nick": "nick999"})))
+
+@bench("select_build")
+def _select_build(cfg):
+    add_index(get_type(Log), "nick")
+    return len(list(find(get_type(Log), {"nick": "nick999"})))
+
+@bench("select_index")
+def _select_index(cfg):
+    add_index(get_type(Log), "nick")
+    nr = len(list(find(get_type(Log), {"nick": "nick999"})))
+    zbot.obj.indexed.pop(get_type(Log), None)
+    return nr
+
+@bench("text_scan")
+def _text_scan(cfg):
+    return len([o for o in find(get_type(Log)) if "word4242 " in o.txt + " "])
+
+@bench("text_build")
+def _text_build(cfg):
+    add_index(get_type(Log), "txt", "text")
+    return len(list(grep(get_type(Log), "word4242")))
+
+@bench("text_search", 100)
+def _text_search(cfg):
+    add_index(get_type(Log), "txt", "text")
+    for _x in range(100):
+        list(grep(get_type(Log), "word4242"))
+    zbot.obj.indexed.pop(get_type(Log), None)
+
+@bench("timed_2h")
+def _timed(cfg):
+    timed = Object()
+    timed["from"] = time.time() - 2 * 60 * 60
+    timed["to"] = time.time()
+    return len(list(find(get_type(Log), timed=timed)))
+
+@bench("last", 1000)
+def _last(cfg):
+    for _x in range(1000):
+        last(Setting())
+
+@bench("save_concurrent")
+def _concurrent(cfg):
+    nrthreads = int(cfg.threads or 4)
+    per = int(cfg.per or 250)
+    def saver(nr):
+        for x in range(per):
+            o = Log()
+            o.nick = "thread%s" % nr
+            o.txt = "line %s" % x
+            save(o)
+    thrs = [threading.Thread(target=saver, args=(x,)) for x in range(nrthreads)]
+    for thr in thrs:
+        thr.start()
+    for thr in thrs:
+        thr.join()
+    return nrthreads * per
+
+def wide(nr=200):
+    o = Object()
+    for x in range(nr):
+        o["field%s" % x] = "value%s" % x
+    for x in range(5):
+        o["nested%s" % x] = Person()
+    o.people = [Person() for _x in range(5)]
+    return o
+
+@bench("stamp_wide", 2000)
+def _stamp_wide(cfg):
+    o = wide()
+    for _x in range(2000):
+        unstamp(stamp(o))
+
+@bench("bus_say", 10000)
+def _bus_say(cfg):
+    from zbot.hdl import bus
+    class Sink(Object):
+        def say(self, channel, txt):
+            pass
+    sinks = [Sink() for _x in range(1000)]
+    for s in sinks:
+        bus.add(s)
+    orig = repr(sinks[-1])
+    for _x in range(10000):
+        bus.say(orig, "#chan", "txt")
+    for s in sinks:
+        bus.remove(s)
+
+@bench("irc_parse", 10000)
+def _irc_parse(cfg):
+    i = ircparser()
+    for line in lines(10000):
+        e = i._parsing(line)
+        parse(e, e.txt)
+
+def memory(name, make, nr=1000):
+    tracemalloc.start()
+    start = time.perf_counter()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [make(x) for x in range(nr)]
+    after = tracemalloc.get_traced_memory()[0]
+    secs = time.perf_counter() - start
+    tracemalloc.stop()
+    results[name] = {"ops": len(objs), "seconds": round(secs, 6), "rate": round(len(objs) / secs, 2),
+                     "bytes": round((after - before) / len(objs), 1)}
+
+def _irc_memory(cfg):
+    i = ircparser()
+    txts = lines(1000)
+    memory("irc_memory", lambda x: i._parsing(txts[x]))
+
+def _mem_cfg(cfg):
+    from zbot.irc import Cfg
+    memory("mem_cfg", lambda x: Cfg())
+
+def _mem_event(cfg):
+    from zbot.hdl import Event
+    memory("mem_event", lambda x: Event())
+
+def _mem_user(cfg):
+    from zbot.irc import User
+    def make(x):
+        u = User()
+        u.user = "nick%s!~user@host%s" % (x, x % 97)
+        u.perms = ["USER"]
+        return u
+    memory("mem_user", make)
+
+scenarios.append(("irc_memory", _irc_memory))
+scenarios.append(("mem_cfg", _mem_cfg))
+scenarios.append(("mem_event", _mem_event))
+scenarios.append(("mem_user", _mem_user))
+
+def run(cfg):
+    results.clear()
+    wd = cfg.wd or tempfile.mkdtemp(prefix="zbnc")
+    zbot.obj.workdir = wd
+    set_engine(cfg.store or "files")
+    zbot.obj.codec = cfg.codec or "json"
+    zbot.obj.group = bool(cfg.group)
+    cold()
+    if not os.path.exists(os.path.join(wd, "index")):
+        start = time.perf_counter()
+        nr = generate(cfg)
+        secs = time.perf_counter() - start
+        results["save"] = {"ops": nr, "seconds": round(secs, 6), "rate": round(nr / secs, 2)}
+    only = cfg.only.split(",") if cfg.only else []
+    for name, func in scenarios:
+        if only and name not in only:
+            continue
+        func(cfg)
+    meta = {"size": int(cfg.size or 10000), "mix": ",".join(["%s:%s" % x for x in mix(cfg)]),
+            "store": cfg.store or "files", "codec": zbot.obj.codec, "group": zbot.obj.group, "threads": int(cfg.threads or 4), "python": sys.version.split()[0],
+            "time": time.time()}
+    if not cfg.wd and not cfg.keep:
+        shutil.rmtree(wd, ignore_errors=True)
+    return {"meta": meta, "results": dict(results)}
+
+def main():
+    cfg = Default()
+    parse(cfg, " ".join(sys.argv[1:]))
+    if cfg.cmd == "compare" and len(cfg.args) == 2:
+        print("\n".join(compare(*cfg.args)))
+        return
+    if cfg.cmd == "backends":
+        print("\n".join(backends(cfg)))
+        return
+    res = run(cfg)
+    txt = json.dumps(res, indent=4, sort_keys=True)
+    if cfg.out:
+        with open(cfg.out, "w") as ofile:
+            ofile.write(txt + "\n")
+    print(txt)
+
+if __name__ == "__main__":
+    main()
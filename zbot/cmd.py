@@ -4,22 +4,129 @@
 
 import time
 import threading
+import zbot.obj
 
-from zbot.obj import Object, get, get_type, update
-from zbot.csl import elapsed, starttime
-from zbot.hdl import get_kernel, find_modules
+from zbot.obj import Default, Object, compact, convert, export, format, get, get_type, grep, migrate, reindex, restore, update
+from zbot.csl import elapsed, parse, parse_time, starttime, to_day
+from zbot.hdl import Repeater, bus, get_kernel, limit, pool, scheduler, find_modules
 
 def __dir__():
-    return ("cmd", "krn", "mds", "tsk", "ver", "wd")
+    return ("cmd", "cnv", "cpt", "exp", "grp", "idx", "imp", "init", "krn", "mds", "mig", "sts", "tsk", "ver", "wd")
 
 k = get_kernel()
+compactor = None
+
+def init(kernel):
+    global compactor
+    if not kernel.cfg.compact or compactor:
+        return compactor
+    retention = parse_time(kernel.cfg.retain) if kernel.cfg.retain else None
+    compactor = Repeater(float(parse_time(kernel.cfg.compact) or kernel.cfg.compact), compactall, int(kernel.cfg.keep or 1),
+                         retention, name="compact")
+    compactor.start()
+    return compactor
+
+def compactall(keep=1, retention=None):
+    res = []
+    for otype in zbot.obj.engine.types():
+        res.append((otype, compact(otype, keep, retention)))
+    return res
 
 def cmd(event):
     event.reply(",".join(sorted(k.cmds)))
 
+@limit(1)
+def cnv(event):
+    if not event.args or event.args[0] not in zbot.obj.engines:
+        event.reply("cnv <%s>" % "|".join(zbot.obj.engines))
+        return
+    start = time.time()
+    nr = convert(event.args[0])
+    event.reply("converted %s objects to %s in %.3fs" % (nr, event.args[0], time.time() - start))
+
+@limit(1)
+def cpt(event):
+    o = Default()
+    parse(o, event.origtxt or event.txt)
+    retain = get(o.sets, "retain", None)
+    retention = parse_time(retain) if retain else None
+    keep = int(get(o.sets, "keep", 1))
+    if o.args:
+        res = [(otype, compact(otype, keep, retention)) for otype in types(o.args)]
+    else:
+        res = compactall(keep, retention)
+    for otype, r in res:
+        event.reply("%s versions=%s objects=%s bytes=%s inodes=%s" % (otype, r.versions, r.objects, r.bytes, r.inodes))
+    if not res:
+        event.reply("no types")
+
+def exp(event):
+    if not event.args:
+        event.reply("exp <file> [type ..] [from=<time>] [to=<time>]")
+        return
+    start = time.time()
+    nr = export(event.args[0], types(event.args[1:]), timed(event))
+    event.reply("exported %s objects to %s in %.3fs" % (nr, event.args[0], time.time() - start))
+
+def grp(event):
+    if len(event.args) < 2:
+        event.reply("grp <type> <word> [word ..]")
+        return
+    otype = types(event.args[:1])[0]
+    nr = 0
+    for o in grep(otype, " ".join(event.args[1:]), event.timed or None):
+        event.reply("%s %s" % (nr, format(o)))
+        nr += 1
+    if not nr:
+        event.reply("no result")
+
+@limit(1)
+def imp(event):
+    if not event.args:
+        event.reply("imp <file> [type ..] [from=<time>] [to=<time>]")
+        return
+    start = time.time()
+    nr = restore(event.args[0], types(event.args[1:]), timed(event))
+    event.reply("imported %s objects from %s in %.3fs" % (nr, event.args[0], time.time() - start))
+
+def idx(event):
+    otypes = event.args or zbot.obj.engine.types()
+    res = []
+    for otype in otypes:
+        if not otype:
+            continue
+        res.append("%s=%s" % (otype, reindex(otype)))
+    event.reply(" ".join(res) or "no types")
+
 def mds(event):
     event.reply(",".join([m.__name__.split(".")[-1] for m in find_modules("zbot,mods")]))
 
+@limit(1)
+def mig(event):
+    if not event.args or event.args[0] not in zbot.obj.codecs:
+        event.reply("mig <%s> [type ..]" % "|".join(zbot.obj.codecs))
+        return
+    otypes = event.args[1:] or zbot.obj.engine.types()
+    res = []
+    for otype in otypes:
+        res.append("%s=%s" % (otype, migrate(otype, event.args[0])))
+    event.reply(" ".join(res) or "no types")
+
+def sts(event):
+    c = zbot.obj.cache
+    event.reply("cache hits=%s misses=%s objs=%s size=%s limit=%s" % (c.hits, c.misses, len(c.objs), c.size, c.limit))
+    r = get_kernel().recovery
+    if r and r.skipped:
+        event.reply("recovery skipped, %s is owned by another process" % zbot.obj.workdir)
+    elif r:
+        event.reply("recovery types=%s checked=%s dropped=%s orphans=%s temps=%s torn=%s %ss" % (r.types, r.checked,
+                    r.dropped, r.orphans, r.temps, r.torn, r.seconds))
+    for cmd, m in sorted(get_kernel().metrics.items()):
+        event.reply("cmd %s nr=%s delay=%.6fs maxdelay=%.6fs busy=%.6fs" % (cmd, m["nr"], m["delay"] / m["nr"],
+                                                                          m["maxdelay"], m["busy"] / m["nr"]))
+    for orig, stats in sorted(bus.stats.items()):
+        event.reply("bus %s %s" % (orig, " ".join(["%s=%s" % x for x in sorted(stats.items())])))
+
 def tsk(event):
     psformat = "%-8s %-50s"
     result = []
@@ -37,9 +144,39 @@ def tsk(event):
     nr = -1
     for up, thrname, o in sorted(result, key=lambda x: x[0]):
         nr += 1
+        if thrname in pool.busy:
+            jobname, since = pool.busy[thrname]
+            up = int(time.time() - since)
+            thrname = "%s %s" % (thrname, jobname)
         res = "%s %s" % (nr, psformat % (elapsed(up), thrname[:60]))
         if res:
             event.reply(res.rstrip())
+    for t in scheduler.timers():
+        nr += 1
+        every = " every %s" % elapsed(t.sleep) if isinstance(t, Repeater) else ""
+        txt = "%s in %s%s runs=%s missed=%s" % (t.name, elapsed(max(t.next - time.time(), 0)), every, t.state.runs,
+                                               t.state.missed)
+        event.reply("%s %s" % (nr, txt))
+    event.reply("pool workers=%s/%s busy=%s queued=%s/%s done=%s shed=%s" % (len(pool.threads), pool.workers,
+                len(pool.busy), pool.queue.qsize(), pool.queue.maxsize, pool.done, pool.shedded))
+
+def timed(event):
+    t = Object()
+    if event.timed:
+        update(t, event.timed)
+    for k in ("from", "to"):
+        v = get(event.sets, k) if event.sets else None
+        if v:
+            secs = parse_time(v)
+            t[k] = time.time() - secs if secs else to_day(v)
+    return t or None
+
+def types(args):
+    stored = zbot.obj.engine.types()
+    res = []
+    for x in args:
+        res.extend([t for t in stored if t.split(".")[-1].lower() == x.lower()] or [x])
+    return res
 
 def ver(event):
     for mod in k.walk("zbot"):
@@ -14,7 +14,7 @@ import threading
 import zbot.obj
 
 from zbot.obj import Default, Object, cdir, fntime, last, save, update
-from zbot.hdl import Cfg, Event, Kernel, get_kernel, launch, starttime
+from zbot.hdl import Cfg, Event, Kernel, get_kernel, launch, pool, starttime
 
 def __dir__():
     return ("Console", "execute", "elapsed", "parse", "parse_time", "parse_cli")
@@ -80,7 +80,7 @@ class Console(Object):
     def start(self):
         k = get_kernel()
         setcompleter(k.cmds)
-        launch(self.input)
+        launch(self.input, pool=False)
 
 class Token(Object):
 
@@ -191,6 +191,26 @@ def boot(name, wd=""):
     parse(k.cfg, " ".join(sys.argv[1:]))
     zbot.obj.workdir = k.cfg.wd = wd or os.path.expanduser("~/.%s" % name)
     cdir(zbot.obj.workdir)
+    zbot.obj.set_engine(k.cfg.store)
+    if k.cfg.cache:
+        zbot.obj.cache.limit = int(k.cfg.cache)
+    zbot.obj.codec = k.cfg.codec or zbot.obj.codec
+    zbot.obj.group = bool(k.cfg.group)
+    if k.cfg.workers:
+        pool.workers = int(k.cfg.workers)
+    if k.cfg.depth:
+        pool.queue.maxsize = int(k.cfg.depth)
+    pool.shed = bool(k.cfg.shed)
+    for item in [x for x in (k.cfg.text or "").split(",") if x]:
+        name, _sep, key = item.rpartition(":")
+        stored = [t for t in zbot.obj.engine.types() if t.split(".")[-1].lower() == name.lower()]
+        for otype in stored or [name]:
+            zbot.obj.add_index(otype, key, "text")
+    k.recovery = zbot.obj.recover()
+    if k.recovery.dropped or k.recovery.orphans or k.recovery.torn:
+        print("recovered %s: dropped=%s orphans=%s torn=%s in %ss" % (zbot.obj.workdir, k.recovery.dropped,
+                                                                     k.recovery.orphans, k.recovery.torn,
+                                                                     k.recovery.seconds))
     return k
 
 def root():
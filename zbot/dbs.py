@@ -0,0 +1,325 @@
+# ZBOT - 24/7 channel daemon
+#
+#
+
+import os
+import sqlite3
+import threading
+import _thread
+
+import zbot.obj
+
+from zbot.obj import Files, cdir, fntime, fsync
+
+def __dir__():
+    return ("Segments", "Sqlite")
+
+class Segments(Files):
+
+    limit = 64 * 1024 * 1024
+
+    def __init__(self):
+        super().__init__()
+        self.current = {}
+        self.fds = {}
+        self.lock = _thread.allocate_lock()
+        self.offsets = {}
+        self.retired = []
+
+    def fd(self, otype, seg):
+        fn = os.path.join(zbot.obj.workdir, "segments", otype, "%08d.seg" % seg)
+        with self.lock:
+            if fn not in self.fds:
+                self.fds[fn] = os.open(fn, os.O_RDONLY)
+            return self.fds[fn]
+
+    def flush(self, paths):
+        rest = []
+        otypes = set()
+        for path in paths:
+            if self.locate(path):
+                otypes.add(path.split(os.sep)[0])
+            else:
+                rest.append(path)
+        super().flush(rest)
+        for otype in otypes:
+            p = os.path.join(zbot.obj.workdir, "segments", otype)
+            fsync(os.path.join(p, "%08d.seg" % self.segment(otype)))
+            fsync(os.path.join(p, "offsets"))
+
+    def locate(self, path):
+        otype = path.split(os.sep)[0]
+        if otype not in self.offsets or path not in self.offsets[otype][2]:
+            self.refresh(otype)
+        return self.offsets[otype][2].get(path, None)
+
+    def read(self, path):
+        otype = path.split(os.sep)[0]
+        loc = self.locate(path)
+        if not loc:
+            return super().read(path)
+        try:
+            return os.pread(self.fd(otype, loc[0]), loc[2], loc[1])
+        except FileNotFoundError:
+            self.refresh(otype)
+        loc = self.locate(path)
+        if not loc:
+            return super().read(path)
+        return os.pread(self.fd(otype, loc[0]), loc[2], loc[1])
+
+    def recover(self, otype, paths):
+        fn = os.path.join(zbot.obj.workdir, "segments", otype, "offsets")
+        nr = super().recover(otype, [p for p in paths if not self.locate(p)])
+        if not os.path.exists(fn):
+            return nr
+        with self.lock:
+            with open(fn, "rb+") as ofile:
+                size = ofile.seek(0, 2)
+                ofile.seek(max(0, size - 4096))
+                chunk = ofile.read()
+                if chunk and not chunk.endswith(b"\n"):
+                    ofile.truncate(size - len(chunk.rsplit(b"\n", 1)[-1]))
+                    nr += 1
+            self.offsets.pop(otype, None)
+        return nr
+
+    def refresh(self, otype):
+        fn = os.path.join(zbot.obj.workdir, "segments", otype, "offsets")
+        with self.lock:
+            ino, pos, locs = self.offsets.get(otype, (None, 0, {}))
+            try:
+                st = os.stat(fn)
+            except FileNotFoundError:
+                self.offsets[otype] = (None, 0, {})
+                return
+            if st.st_ino != ino or st.st_size < pos:
+                ino, pos, locs = st.st_ino, 0, {}
+            with open(fn, "rb") as ofile:
+                ofile.seek(pos)
+                for line in ofile:
+                    if not line.endswith(b"\n"):
+                        break
+                    pos += len(line)
+                    path, seg, offset, length = str(line, "utf-8").rstrip("\n").split("\t")
+                    locs[path] = (int(seg), int(offset), int(length))
+            self.offsets[otype] = (ino, pos, locs)
+
+    def replace(self, path, data):
+        self.writemany([(path, data)])
+
+    def remove(self, paths):
+        byotype = {}
+        rest = []
+        for path in paths:
+            otype = path.split(os.sep)[0]
+            if self.locate(path):
+                byotype.setdefault(otype, set()).add(path)
+            else:
+                rest.append(path)
+        nbytes, inodes = super().remove(rest)
+        for otype, removed in byotype.items():
+            b, i = self.rewrite(otype, removed)
+            nbytes += b
+            inodes += i
+        return nbytes, inodes
+
+    def rewrite(self, otype, removed):
+        p = os.path.join(zbot.obj.workdir, "segments", otype)
+        with self.lock:
+            old = self.segment(otype)
+            target = old + 1
+            self.current[otype] = target + 1
+        self.refresh(otype)
+        locs = dict(self.offsets[otype][2])
+        olds = [x for x in os.listdir(p) if x.endswith(".seg") and int(x[:-4]) <= old]
+        nbytes = sum([os.path.getsize(os.path.join(p, x)) for x in olds])
+        moved = {}
+        with open(os.path.join(p, "%08d.seg" % target), "ab") as sfile:
+            for path, (seg, offset, length) in sorted(locs.items(), key=lambda x: x[1]):
+                if seg > old or path in removed:
+                    continue
+                data = os.pread(self.fd(otype, seg), length, offset)
+                header = bytes("%s %s\n" % (path, length), "utf-8")
+                moved[path] = (target, sfile.tell() + len(header), length)
+                sfile.write(header + data + b"\n")
+            nbytes -= sfile.tell()
+        fn = os.path.join(p, "offsets")
+        tmp = "%s.%s" % (fn, os.getpid())
+        with self.lock:
+            with open(tmp, "w") as ofile:
+                for path, (seg, offset, length) in sorted(moved.items(), key=lambda x: x[1]):
+                    ofile.write("%s\t%s\t%s\t%s\n" % (path, seg, offset, length))
+                with open(fn, "r") as tfile:
+                    for line in tfile:
+                        if not line.endswith("\n"):
+                            break
+                        path, seg, offset, length = line.rstrip("\n").split("\t")
+                        if int(seg) > target:
+                            ofile.write(line)
+            os.replace(tmp, fn)
+            for fd in self.retired:
+                os.close(fd)
+            self.retired = []
+            for x in olds:
+                sfn = os.path.join(p, x)
+                if sfn in self.fds:
+                    self.retired.append(self.fds.pop(sfn))
+                os.remove(sfn)
+        self.refresh(otype)
+        return nbytes, max(len(olds) - 1, 0)
+
+    def segment(self, otype):
+        if otype not in self.current:
+            p = os.path.join(zbot.obj.workdir, "segments", otype)
+            segs = [int(x[:-4]) for x in os.listdir(p) if x.endswith(".seg")] if os.path.exists(p) else []
+            self.current[otype] = max(segs or [0])
+        return self.current[otype]
+
+    def since(self, otype, t):
+        self.refresh(otype)
+        locs = self.offsets[otype][2]
+        paths = [p for p in locs if fntime(p) >= t]
+        for path in super().since(otype, t):
+            if path not in locs:
+                yield path
+        yield from paths
+
+    def types(self):
+        res = super().types()
+        p = os.path.join(zbot.obj.workdir, "segments")
+        if os.path.exists(p):
+            res.extend([x for x in os.listdir(p) if x not in res])
+        return res
+
+    def walk(self, otype):
+        self.refresh(otype)
+        paths = list(self.offsets[otype][2])
+        known = set(paths)
+        for path in super().walk(otype):
+            if path not in known:
+                yield path
+        yield from paths
+
+    def write(self, path, data):
+        self.writemany([(path, data)])
+
+    def writemany(self, items):
+        if not items:
+            return
+        otype = items[0][0].split(os.sep)[0]
+        p = os.path.join(zbot.obj.workdir, "segments", otype)
+        with self.lock:
+            seg = self.segment(otype)
+            fn = os.path.join(p, "%08d.seg" % seg)
+            cdir(fn)
+            if os.path.exists(fn) and os.path.getsize(fn) > self.limit:
+                seg = self.current[otype] = seg + 1
+                fn = os.path.join(p, "%08d.seg" % seg)
+            records = []
+            offsets = []
+            with open(fn, "ab") as sfile:
+                offset = sfile.tell()
+                for path, data in items:
+                    header = bytes("%s %s\n" % (path, len(data)), "utf-8")
+                    offsets.append("%s\t%s\t%s\t%s\n" % (path, seg, offset + len(header), len(data)))
+                    records.append(header + data + b"\n")
+                    offset += len(records[-1])
+                sfile.write(b"".join(records))
+            with open(os.path.join(p, "offsets"), "a") as ofile:
+                ofile.write("".join(offsets))
+            if otype in self.offsets:
+                for line in offsets:
+                    path, seg, offset, length = line.rstrip("\n").split("\t")
+                    self.offsets[otype][2][path] = (int(seg), int(offset), int(length))
+
+class Sqlite(Files):
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def db(self):
+        fn = os.path.join(zbot.obj.workdir, "store.db")
+        if getattr(self.local, "fn", None) != fn:
+            cdir(fn)
+            con = sqlite3.connect(fn, timeout=60.0, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("CREATE TABLE IF NOT EXISTS objects (path TEXT PRIMARY KEY, otype TEXT NOT NULL, "
+                        "time REAL NOT NULL, data BLOB NOT NULL)")
+            con.execute("CREATE INDEX IF NOT EXISTS objects_otype ON objects (otype, time)")
+            self.local.con = con
+            self.local.fn = fn
+        return self.local.con
+
+    def flush(self, paths):
+        super().flush([p for p in paths if os.path.exists(os.path.join(zbot.obj.workdir, "store", p))])
+        self.db().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def read(self, path):
+        row = self.db().execute("SELECT data FROM objects WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return super().read(path)
+        return row[0]
+
+    def remove(self, paths):
+        con = self.db()
+        nbytes = 0
+        rest = []
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for path in paths:
+                row = con.execute("SELECT length(data) FROM objects WHERE path = ?", (path,)).fetchone()
+                if row is None:
+                    rest.append(path)
+                    continue
+                con.execute("DELETE FROM objects WHERE path = ?", (path,))
+                nbytes += row[0]
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        b, inodes = super().remove(rest)
+        return nbytes + b, inodes
+
+    def replace(self, path, data):
+        self.writemany([(path, data)])
+
+    def since(self, otype, t):
+        paths = [p for (p,) in self.db().execute("SELECT path FROM objects WHERE otype = ? AND time >= ?", (otype, t))]
+        known = set(paths)
+        for path in super().since(otype, t):
+            if path not in known:
+                yield path
+        yield from paths
+
+    def types(self):
+        res = super().types()
+        for (otype,) in self.db().execute("SELECT DISTINCT otype FROM objects"):
+            if otype not in res:
+                res.append(otype)
+        return res
+
+    def walk(self, otype):
+        paths = [p for (p,) in self.db().execute("SELECT path FROM objects WHERE otype = ?", (otype,))]
+        known = set(paths)
+        for path in super().walk(otype):
+            if path not in known:
+                yield path
+        yield from paths
+
+    def write(self, path, data):
+        self.writemany([(path, data)])
+
+    def writemany(self, items):
+        if not items:
+            return
+        con = self.db()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                            [(p, p.split(os.sep)[0], fntime(p), data) for p, data in items])
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
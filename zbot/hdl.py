@@ -4,71 +4,91 @@
 
 __version__ = 59
 
+import asyncio
+import collections
+import heapq
 import importlib
 import importlib.util
 import inspect
+import itertools
 import os
 import pkgutil
 import queue
+import random
 import sys
 import time
 import threading
 import traceback
+import weakref
 import zipfile
 import _thread
 import zbot.obj
 
-from zbot.obj import Cfg, Default, Object, Ol, cdir, get, get_name, last, locked, save, update
+from zbot.obj import Cfg, Default, Object, Ol, Record, cdir, get, get_name, last, save, update
 
 def __dir__():
-    return ("Cfg", "Event", "Kernel", "direct", "get_exception", "get_kernel", "launch", "starttime")
+    return ("Cfg", "Event", "Job", "Kernel", "Pool", "Repeater", "Scheduler", "Timer", "direct", "get_exception",
+            "get_kernel", "launch", "limit", "pool", "scheduler", "starttime")
 
-dispatchlock = _thread.allocate_lock()
 starttime = time.time()
 
 class Bus(Object):
 
-    objs = []
+    objs = weakref.WeakValueDictionary()
+    stats = {}
 
     def __iter__(self):
-        return iter(Bus.objs)
+        return iter(list(Bus.objs.values()))
 
     def add(self, obj):
-        Bus.objs.append(obj)
+        orig = repr(obj)
+        Bus.objs[orig] = obj
+        Bus.stats[orig] = collections.Counter()
+        weakref.finalize(obj, Bus.stats.pop, orig, None)
 
     def announce(self, txt, skip=None):
-        for h in self.objs:
+        for orig, h in list(Bus.objs.items()):
             if skip is not None and isinstance(h, skip):
                 continue
-            if "announce" in dir(h):
+            if hasattr(h, "announce"):
+                Bus.stats[orig]["announce"] += 1
                 h.announce(txt)
 
     def dispatch(self, event):
-        for b in Bus.objs:
-            if repr(b) == event.orig:
-                b.dispatch(event)
+        b = self.by_orig(event.orig)
+        if b is not None:
+            Bus.stats[event.orig]["dispatch"] += 1
+            b.dispatch(event)
 
     def by_orig(self, orig):
-        for o in Bus.objs:
-            if repr(o) == orig:
-                return o
+        return Bus.objs.get(orig, None)
+
+    def remove(self, obj):
+        orig = repr(obj)
+        if Bus.objs.get(orig, None) is obj:
+            del Bus.objs[orig]
+            Bus.stats.pop(orig, None)
 
     def say(self, orig, channel, txt):
-        for o in Bus.objs:
-            if repr(o) == orig:
-                o.say(channel, str(txt))
+        o = self.by_orig(orig)
+        if o is not None:
+            Bus.stats[orig]["say"] += 1
+            o.say(channel, str(txt))
 
 class Cfg(Cfg):
 
     pass
 
-class Event(Default):
+class Event(Record, Default):
+
+    __slots__ = ("args", "cmd", "queued", "ready", "rest", "result", "thrs", "txt")
 
     def __init__(self):
         super().__init__()
         self.args = []
         self.cmd = ""
-        self.ready = threading.Event()
+        self.queued = 0
+        self.ready = Ready()
         self.rest = ""
         self.result = []
         self.thrs = []
@@ -106,7 +126,11 @@ class Handler(Object):
     def __init__(self):
         super().__init__()
         self.cmds = Object()
+        self.dlock = _thread.allocate_lock()
+        self.limits = {}
+        self.metrics = {}
         self.packages = []
+        self.pending = {}
         self.queue = queue.Queue()
         self.stopped = False
 
@@ -118,17 +142,37 @@ class Handler(Object):
         self.dispatch(e)
         return e
 
-    @locked(dispatchlock)
     def dispatch(self, e):
         e.parse()
-        if e.cmd in self.cmds:
+        func = get(self.cmds, e.cmd)
+        if func:
+            sem = self.semaphore(e.cmd, func)
+            if sem:
+                sem.acquire()
+            start = time.time()
             try:
-                self.cmds[e.cmd](e)
+                if inspect.iscoroutinefunction(func):
+                    asyncio.run(func(e))
+                else:
+                    func(e)
             except Exception as ex:
                 print(get_exception())
+            finally:
+                if sem:
+                    sem.release()
+                self.measure(e.cmd, start - (e.queued or start), time.time() - start)
         e.show()
         e.ready.set()
 
+    def drain(self, key):
+        while True:
+            with self.dlock:
+                if not self.pending[key]:
+                    del self.pending[key]
+                    break
+                event = self.pending[key].popleft()
+            self.dispatch(event)
+
     def handler(self):
         while not self.stopped:
             event = self.queue.get()
@@ -136,22 +180,52 @@ class Handler(Object):
                 break
             if not event.orig:
                 event.orig = repr(self)
-            if event.txt:
-                launch(self.dispatch, event, name=event.txt.split()[0])
-            else:
+            if not event.txt:
                 event.ready.set()
+                continue
+            event.queued = time.time()
+            key = event.origin or event.orig
+            with self.dlock:
+                if key in self.pending:
+                    self.pending[key].append(event)
+                    continue
+                self.pending[key] = collections.deque([event])
+            job = launch(self.drain, key, name=event.txt.split()[0])
+            if job.shed:
+                with self.dlock:
+                    for e in self.pending.pop(key, ()):
+                        e.ready.set()
 
     def load_mod(self, name):
         mod = direct(name)
         self.scan(mod)
         return mod
 
+    def measure(self, cmd, delay, busy):
+        with self.dlock:
+            if cmd not in self.metrics:
+                self.metrics[cmd] = collections.Counter()
+            m = self.metrics[cmd]
+            m["nr"] += 1
+            m["delay"] += delay
+            m["busy"] += busy
+            m["maxdelay"] = max(m["maxdelay"], delay)
+
     def scan(self, mod):
         cmds = find_cmds(mod)
         update(self.cmds, cmds)
 
+    def semaphore(self, cmd, func):
+        nr = getattr(func, "limit", None)
+        if not nr:
+            return None
+        with self.dlock:
+            if cmd not in self.limits:
+                self.limits[cmd] = threading.BoundedSemaphore(nr)
+            return self.limits[cmd]
+
     def start(self):
-        launch(self.handler)
+        launch(self.handler, pool=False)
 
     def stop(self):
         self.stopped = True
@@ -176,11 +250,27 @@ class Handler(Object):
             self.packages.append(name)
         return modules
 
+class Job(Object):
+
+    def __init__(self, func, args, name):
+        super().__init__()
+        self.args = args
+        self.func = func
+        self.name = name
+        self.ready = Ready()
+        self.result = None
+        self.shed = False
+
+    def join(self, timeout=None):
+        self.ready.wait(-1 if timeout is None else timeout)
+        return self.result
+
 class Kernel(Handler):
 
     def __init__(self):
         super().__init__()
         self.ready = threading.Event()
+        self.recovery = None
         self.stopped = False
         self.cfg = Cfg()
         kernels.append(self)
@@ -240,6 +330,8 @@ class Kernel(Handler):
     def start(self):
         assert zbot.obj.workdir
         self.init(self.cfg.mods)
+        if self.cfg.compact:
+            self.init("cmd")
         super().start()
 
     def stop(self):
@@ -250,6 +342,105 @@ class Kernel(Handler):
         while not self.stopped:
             time.sleep(60.0)
 
+class Pool(Object):
+
+    def __init__(self, workers=16, depth=1024, shed=False):
+        super().__init__()
+        self.backlog = 0
+        self.busy = {}
+        self.done = 0
+        self.idle = 0
+        self.lock = _thread.allocate_lock()
+        self.queue = queue.Queue(depth)
+        self.shed = shed
+        self.shedded = 0
+        self.submitted = 0
+        self.threads = []
+        self.workers = workers
+
+    def put(self, job, block=True):
+        inworker = threading.current_thread() in self.threads
+        with self.lock:
+            self.submitted += 1
+            if self.idle:
+                self.idle -= 1
+                reserved = "idle"
+            elif len(self.threads) < self.workers:
+                thr = threading.Thread(None, self.work, "pool-%s" % len(self.threads), daemon=True)
+                self.threads.append(thr)
+                thr.start()
+                reserved = "thread"
+            elif inworker:
+                reserved = None
+            else:
+                self.backlog += 1
+                reserved = "backlog"
+        if not reserved:
+            self.run(job)
+            return
+        try:
+            self.queue.put(job, block and not self.shed and not inworker)
+        except queue.Full:
+            with self.lock:
+                if reserved == "backlog":
+                    self.backlog -= 1
+                else:
+                    self.idle += 1
+            if inworker and not self.shed:
+                self.run(job)
+                return
+            with self.lock:
+                self.shedded += 1
+            job.shed = True
+            job.ready.set()
+
+    def run(self, job):
+        name = threading.current_thread().name
+        self.busy[name] = (job.name, time.time())
+        try:
+            job.result = job.func(*job.args)
+        except EOFError:
+            _thread.interrupt_main()
+        except Exception as _ex:
+            print(get_exception())
+        finally:
+            self.busy.pop(name, None)
+            with self.lock:
+                self.done += 1
+            job.ready.set()
+
+    def work(self):
+        while True:
+            self.run(self.queue.get())
+            with self.lock:
+                if self.backlog:
+                    self.backlog -= 1
+                else:
+                    self.idle += 1
+
+class Ready:
+
+    __slots__ = ("lock",)
+
+    def __init__(self):
+        self.lock = _thread.allocate_lock()
+        self.lock.acquire()
+
+    def is_set(self):
+        return not self.lock.locked()
+
+    def set(self):
+        try:
+            self.lock.release()
+        except RuntimeError:
+            pass
+
+    def wait(self, timeout=-1):
+        if self.lock.acquire(timeout=timeout):
+            self.lock.release()
+            return True
+        return False
+
 class Task(threading.Thread):
 
     def __init__(self, func, *args, name="noname", daemon=True):
@@ -282,6 +473,40 @@ class Task(threading.Thread):
         super().join(timeout)
         return self._result
 
+class Scheduler(Object):
+
+    def __init__(self):
+        super().__init__()
+        self.cond = threading.Condition()
+        self.heap = []
+        self.nr = itertools.count()
+        self.thread = None
+
+    def add(self, timer):
+        with self.cond:
+            heapq.heappush(self.heap, (timer.next, next(self.nr), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(None, self.run, "scheduler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                when, _nr, timer = heapq.heappop(self.heap)
+            if timer.stopped or when != timer.next:
+                continue
+            try:
+                timer.run()
+            except Exception as ex:
+                print(get_exception())
+
+    def timers(self):
+        with self.cond:
+            return sorted([t for when, _nr, t in self.heap if not t.stopped and when == t.next], key=lambda x: x.next)
+
 class Timer(Object):
 
     def __init__(self, sleep, func, *args, **kwargs):
@@ -289,42 +514,60 @@ class Timer(Object):
         self.func = func
         self.sleep = sleep
         self.args = args
+        self.jitter = kwargs.pop("jitter", 0.0)
+        self.missed = kwargs.pop("missed", "skip")
         self.name = kwargs.get("name", "")
         self.kwargs = kwargs
+        self.due = 0
+        self.next = 0
         self.state = Object()
-        self.timer = None
+        self.state.missed = 0
+        self.state.runs = 0
+        self.stopped = False
 
-    def run(self, *args, **kwargs):
+    def run(self):
         self.state.latest = time.time()
-        launch(self.func, *self.args, **self.kwargs)
+        job = launch(self.func, *self.args, block=False, **self.kwargs)
+        if job.shed:
+            self.state.missed += 1
+        else:
+            self.state.runs += 1
+
+    def schedule(self, when):
+        self.due = when
+        self.next = when + random.uniform(0, self.jitter) if self.jitter else when
+        scheduler.add(self)
 
     def start(self):
         if not self.name:
             self.name = get_name(self.func)
-        timer = threading.Timer(self.sleep, self.run, self.args, self.kwargs)
-        timer.setName(self.name)
-        timer.setDaemon(True)
-        timer.sleep = self.sleep
-        timer.state = self.state
-        timer.state.starttime = time.time()
-        timer.state.latest = time.time()
-        timer.func = self.func
-        timer.start()
-        self.timer = timer
-        return timer
+        self.kwargs["name"] = self.name
+        self.stopped = False
+        self.state.starttime = self.state.latest = time.time()
+        self.schedule(time.time() + self.sleep)
+        return self
 
     def stop(self):
-        if self.timer:
-            self.timer.cancel()
+        self.stopped = True
 
 class Repeater(Timer):
 
-    def run(self, *args, **kwargs):
-        thr = launch(self.start, **kwargs)
-        super().run(*args, **kwargs)
-        return thr
+    def run(self):
+        now = time.time()
+        nxt = self.due + self.sleep
+        if nxt <= now and self.missed != "catchup":
+            late = int((now - self.due) // self.sleep)
+            self.state.missed += late
+            if self.missed == "delay":
+                nxt = now + self.sleep
+            else:
+                nxt += late * self.sleep
+        self.schedule(nxt)
+        super().run()
 
 bus = Bus()
+pool = Pool()
+scheduler = Scheduler()
 kernels = []
 
 def direct(name):
@@ -388,10 +631,20 @@ def get_kernel():
        
 def launch(func, *args, **kwargs):
     name = kwargs.get("name", get_name(func))
+    if kwargs.get("pool", True):
+        job = Job(func, args, name)
+        pool.put(job, kwargs.get("block", True))
+        return job
     t = Task(func, *args, name=name, daemon=True)
     t.start()
     return t
 
+def limit(nr):
+    def limitdec(func):
+        func.limit = nr
+        return func
+    return limitdec
+
 def list_files(wd):
     path = os.path.join(wd, "store")
     if not os.path.exists(path):
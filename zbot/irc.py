@@ -11,17 +11,20 @@ import threading
 import _thread
 
 from zbot.csl import parse
-from zbot.obj import Cfg, Default, Object, format, last, update, save
-from zbot.hdl import Event, Handler, bus, get_kernel, launch
+from zbot.obj import Cfg, Default, Object, Record, add_index, find, format, get, get_type, last, update, save, unwatch, watch
+from zbot.hdl import Event, Handler, bus, get_kernel, launch, limit
 
 def __dir__():
     return ("Cfg", "DCC", "Event", "IRC", "cfg", "init")
 
-k = get_kernel()
 saylock = _thread.allocate_lock()
 
 def init(kernel):
-    i = IRC()
+    if getattr(kernel, "loop", None):
+        from zbot.aio import IRC as AIRC
+        i = AIRC()
+    else:
+        i = IRC()
     i.start()
     return i
 
@@ -43,7 +46,9 @@ class ENOUSER(Exception):
 
     pass
 
-class Cfg(Cfg):
+class Cfg(Record, Cfg):
+
+    __slots__ = ("channel", "nick", "port", "realname", "server", "username")
 
     def __init__(self):
         super().__init__()
@@ -56,6 +61,8 @@ class Cfg(Cfg):
 
 class Event(Event):
 
+    __slots__ = ("arguments", "channel", "command", "nick", "orig", "origin", "rawstr", "type")
+
     def show(self):
         for txt in self.result:
             bus.say(self.orig, self.channel, txt)
@@ -95,6 +102,7 @@ class IRC(Handler):
         self.state.nrsend = 0
         self.state.pongcheck = False
         self.threaded = False
+        self.watcher = None
         self.register("ERROR", self.ERROR)
         self.register("LOG", self.LOG)
         self.register("NOTICE", self.NOTICE)
@@ -206,6 +214,11 @@ class IRC(Handler):
         for channel in self.channels:
             self.say(channel, txt)
 
+    def chat(self, event):
+        dcc = DCC()
+        dcc.encoding = "utf-8"
+        launch(dcc.connect, event)
+
     def command(self, cmd, *args):
         if not args:
             self.raw(cmd)
@@ -240,8 +253,8 @@ class IRC(Handler):
         assert self.cfg.nick
         super().start()
         self.connect(self.cfg.server, self.cfg.nick)
-        launch(self.input)
-        launch(self.output)
+        launch(self.input, pool=False)
+        launch(self.output, pool=False)
 
     def input(self):
         while not self.stopped:
@@ -294,7 +307,7 @@ class IRC(Handler):
             self.state.pongcheck = False
         if cmd == "001":
             self.state.needconnect = False
-            if "servermodes" in dir(self.cfg):
+            if self.cfg.servermodes:
                 self.raw("MODE %s %s" % (self.cfg.nick, self.cfg.servermodes))
             self.joinall()
         elif cmd == "433":
@@ -321,6 +334,16 @@ class IRC(Handler):
         self.state.last = time.time()
         self.state.nrsend += 1
 
+    def reconfig(self, cfg):
+        if self._connected.is_set():
+            if cfg.nick and cfg.nick != self.cfg.nick:
+                self.command("NICK", cfg.nick)
+            if cfg.channel and cfg.channel not in self.channels:
+                self.command("JOIN", cfg.channel)
+        if cfg.channel and cfg.channel not in self.channels:
+            self.channels.append(cfg.channel)
+        update(self.cfg, cfg)
+
     def register(self, cmd, cb):
         self.cmds[cmd] = cb
 
@@ -335,14 +358,22 @@ class IRC(Handler):
         assert self.cfg.channel
         assert self.cfg.server
         self.channels.append(self.cfg.channel)
-        launch(self.doconnect)
+        self.watcher = watch(get_type(self.cfg), self.reconfig)
+        launch(self.doconnect, pool=False)
+
+    def detach(self):
+        if self.watcher:
+            unwatch(self.watcher)
+            self.watcher = None
+        bus.remove(self)
 
     def stop(self):
         super().stop()
+        self.detach()
         self._outqueue.put((None, None))
         try:
             self._sock.shutdown(2)
-        except OSError:
+        except (AttributeError, OSError):
             pass
 
     def ERROR(self, event):
@@ -367,18 +398,13 @@ class IRC(Handler):
         if event.txt.startswith("DCC CHAT"):
             if self.cfg.users and users.allowed(event.origin, "USER"):
                 return
-            try:
-                dcc = DCC()
-                dcc.encoding = "utf-8"
-                launch(dcc.connect, event)
-                return
-            except ConnectionError:
-                return
+            self.chat(event)
+            return
         if event.txt and event.txt[0] == self.cc:
             if self.cfg.users and not users.allowed(event.origin, "USER"):
                 return
             event.txt = event.txt[1:]
-            k.queue.put(event)
+            get_kernel().queue.put(event)
 
     def QUIT(self, event):
         if self.cfg.server in event.orig:
@@ -422,35 +448,52 @@ class DCC(Handler):
         self._sock = s
         self._fsock = self._sock.makefile("rw")
         self.origin = event.origin
-        launch(self.input)
+        launch(self.input, pool=False)
         super().start()
         self._connected.set()
 
     def input(self):
-        while 1:
+        while not self.stopped:
             try:
                 e = self.poll()
-            except EOFError:
+            except (EOFError, OSError):
                 break
-            k.queue.put(e)
+            get_kernel().queue.put(e)
+        self.stop()
+
+    def event(self, txt):
+        e = Event()
+        parse(e, txt.rstrip())
+        e.channel = self.origin
+        e.origin = self.origin or "root@dcc"
+        e.orig = repr(self)
+        return e
 
     def poll(self):
         self._connected.wait()
-        e = Event()
         txt = self._fsock.readline()
-        txt = txt.rstrip()
-        parse(e, txt)
+        if not txt:
+            raise EOFError
+        e = self.event(txt)
         e._sock = self._sock
         e._fsock = self._fsock
-        e.channel = self.origin
-        e.origin = self.origin or "root@dcc"
-        e.orig = repr(self)
         return e
 
     def say(self, channel, txt):
         self.raw(txt)
 
-class User(Object):
+    def stop(self):
+        super().stop()
+        bus.remove(self)
+        try:
+            self._sock.shutdown(2)
+            self._sock.close()
+        except (AttributeError, OSError):
+            pass
+
+class User(Record):
+
+    __slots__ = ("perms", "user")
 
     def __init__(self):
         super().__init__()
@@ -481,7 +524,7 @@ class Users(Object):
 
     def get_users(self, origin=""):
         s = {"user": origin}
-        return find("okbot.usr.User", s)
+        return find(get_type(User), s)
 
     def get_user(self, origin):
         u = list(self.get_users(origin))
@@ -519,11 +562,14 @@ class Users(Object):
 
 users = Users()
 
+add_index(get_type(User), "user")
+
+@limit(1)
 def cfg(event):
     c = Cfg()
     last(c)
     o = Default()
-    parse(o, event.txt)
+    parse(o, event.origtxt or event.txt)
     if o.sets:
         update(c, o.sets)
         save(c)
@@ -2,25 +2,59 @@
 #
 #
 
+import asyncio
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
 import datetime
+import fcntl
+import functools
+import gzip
 import importlib
 import inspect
+import itertools
 import json
+import marshal
 import os
+import queue
 import random
+import re
 import sys
+import threading
 import time
 import types
 import uuid
 import _thread
 
 def __dir__():
-    return ("ENOCLASS", "ENOFILENAME", "Object", "Ol", "Cfg", "Db", "Default", "edit",
-            "all", "deleted", "find", "lasttype", "lastfn", "os", "format", "get_type", "get",
-            "items", "keys", "last", "load", "register", "save", "search", "sys", "values", "update")
+    return ("ENOCLASS", "ENOFILENAME", "Object", "Ol", "Cache", "Cfg", "Db", "Default", "Fields", "Files",
+            "Json", "Marshal", "Record", "add_index", "afind", "alast", "aload", "asave", "compact", "convert", "dumps", "edit", "all", "deleted", "export", "find", "grep",
+            "lasttype", "lastfn", "loads", "os", "format", "get_index", "get_type", "get", "items",
+            "keys", "last", "load", "loglock", "lookup", "migrate", "recover", "register", "reindex", "restore", "save", "search", "set_engine",
+            "sys", "typelock", "unwatch", "values", "update", "Watch", "watch")
 
-savelock = _thread.allocate_lock()
+codec = "json"
+codecs = {}
+commits = {}
+engines = {"files": "zbot.obj.Files", "segment": "zbot.dbs.Segments", "sqlite": "zbot.dbs.Sqlite"}
+executor = None
+feedlock = _thread.allocate_lock()
+feeds = {}
+group = False
+indexed = {}
+indexes = {}
+indexlock = _thread.allocate_lock()
+interval = 1.0
+locks = {}
+lockslock = _thread.allocate_lock()
+owner = None
+poller = None
+scalars = (str, int, float, bool, type(None))
+watches = {}
 workdir = ""
+workers = 4
 
 class ENOCLASS(Exception):
 
@@ -32,11 +66,22 @@ class ENOFILENAME(Exception):
 
 class Object:
 
-    __slots__ = ("__dict__", "__stamp__")
+    __slots__ = ("__dict__", "_stamp", "__weakref__")
 
-    def __init__(self):
+    @property
+    def __stamp__(self):
+        try:
+            if self._stamp:
+                return self._stamp
+        except AttributeError:
+            pass
         timestamp = str(datetime.datetime.now()).split()
-        self.__stamp__ = os.path.join(get_type(self), str(uuid.uuid4()), os.sep.join(timestamp))
+        self._stamp = os.path.join(get_type(self), str(uuid.uuid4()), os.sep.join(timestamp))
+        return self._stamp
+
+    @__stamp__.setter
+    def __stamp__(self, path):
+        self._stamp = path
 
     def __delitem__(self, k):
         del self.__dict__[k]
@@ -86,12 +131,491 @@ class Cfg(Default):
 
     pass
 
+class Cache(Object):
+
+    def __init__(self, limit=16*1024*1024):
+        super().__init__()
+        self.hits = 0
+        self.limit = limit
+        self.lock = _thread.allocate_lock()
+        self.misses = 0
+        self.objs = collections.OrderedDict()
+        self.size = 0
+
+    def clear(self, path=None):
+        with self.lock:
+            if path is None:
+                self.objs.clear()
+                self.size = 0
+            elif path in self.objs:
+                self.size -= self.objs.pop(path)[1]
+
+    def fetch(self, path):
+        with self.lock:
+            if path not in self.objs:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.objs.move_to_end(path)
+            v = self.objs[path][0]
+        return dup(v)
+
+    def put(self, path, v, size):
+        if size > self.limit:
+            return
+        with self.lock:
+            if path in self.objs:
+                self.size -= self.objs.pop(path)[1]
+            self.objs[path] = (v, size)
+            self.size += size
+            while self.size > self.limit:
+                self.size -= self.objs.popitem(last=False)[1][1]
+
+class Commit(Object):
+
+    def __init__(self, otype):
+        super().__init__()
+        self.batch = 1
+        self.cond = threading.Condition()
+        self.done = 0
+        self.error = (0, None)
+        self.flushing = False
+        self.otype = otype
+        self.pending = []
+
+    def commit(self, item):
+        with self.cond:
+            self.pending.append(item)
+            batch = self.batch
+            while self.flushing and self.done < batch:
+                self.cond.wait()
+            if self.done >= batch:
+                if self.error[0] == batch:
+                    raise self.error[1]
+                return
+            self.flushing = True
+            items = self.pending
+            self.pending = []
+            self.batch += 1
+        try:
+            with typelock(self.otype):
+                write(self.otype, items, True)
+        except Exception as ex:
+            self.error = (batch, ex)
+            raise
+        finally:
+            with self.cond:
+                self.flushing = False
+                self.done = batch
+                self.cond.notify_all()
+
+class Fields(collections.abc.MutableMapping):
+
+    __slots__ = ("o",)
+
+    def __init__(self, o):
+        self.o = o
+
+    def __delitem__(self, k):
+        if k in type(self.o).__fields__:
+            try:
+                type(self.o).__fields__[k].__delete__(self.o)
+            except AttributeError:
+                raise KeyError(k)
+        else:
+            del Record._vars.__get__(self.o)[k]
+
+    def __getitem__(self, k):
+        if k in type(self.o).__fields__:
+            try:
+                return type(self.o).__fields__[k].__get__(self.o)
+            except AttributeError:
+                raise KeyError(k)
+        return Record._vars.__get__(self.o)[k]
+
+    def __iter__(self):
+        for k, d in type(self.o).__fields__.items():
+            try:
+                d.__get__(self.o)
+            except AttributeError:
+                continue
+            yield k
+        yield from list(Record._vars.__get__(self.o))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __setitem__(self, k, v):
+        if k in type(self.o).__fields__:
+            type(self.o).__fields__[k].__set__(self.o, v)
+        else:
+            Record._vars.__get__(self.o)[k] = v
+
+class Files(Object):
+
+    grace = 60.0
+
+    def flush(self, paths):
+        dirs = set()
+        for path in paths:
+            fn = os.path.join(workdir, "store", path)
+            fsync(fn)
+            dirs.add(os.path.dirname(fn))
+        for d in dirs:
+            fsync(d)
+
+    def read(self, path):
+        with open(os.path.join(workdir, "store", path), "rb") as ofile:
+            return ofile.read()
+
+    def recover(self, otype, paths):
+        nr = 0
+        for d in set([os.path.dirname(os.path.join(workdir, "store", p)) for p in paths]):
+            try:
+                fns = os.listdir(d)
+            except FileNotFoundError:
+                continue
+            for fn in fns:
+                if not fn.endswith(".tmp"):
+                    continue
+                tmp = os.path.join(d, fn)
+                try:
+                    if time.time() - os.stat(tmp).st_mtime < self.grace:
+                        continue
+                    os.remove(tmp)
+                except FileNotFoundError:
+                    continue
+                nr += 1
+        return nr
+
+    def replace(self, path, data):
+        opath = os.path.join(workdir, "store", path)
+        tmp = "%s.%s.tmp" % (opath, threading.get_ident())
+        with open(tmp, "wb") as ofile:
+            ofile.write(data)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, opath)
+
+    def remove(self, paths):
+        nbytes = inodes = 0
+        for path in paths:
+            fn = os.path.join(workdir, "store", path)
+            try:
+                nbytes += os.stat(fn).st_size
+                os.remove(fn)
+            except FileNotFoundError:
+                continue
+            inodes += 1
+            for d in (os.path.dirname(fn), os.path.dirname(os.path.dirname(fn))):
+                try:
+                    os.rmdir(d)
+                except OSError:
+                    break
+                inodes += 1
+        return nbytes, inodes
+
+    def since(self, otype, t):
+        first = time.strftime("%Y-%m-%d", time.localtime(t - 24 * 60 * 60))
+        p = os.path.join(workdir, "store", otype)
+        for uid in os.listdir(p) if os.path.exists(p) else []:
+            try:
+                days = os.listdir(os.path.join(p, uid))
+            except OSError:
+                continue
+            for day in days:
+                if day < first:
+                    continue
+                try:
+                    fns = os.listdir(os.path.join(p, uid, day))
+                except OSError:
+                    continue
+                for fn in fns:
+                    path = os.path.join(otype, uid, day, fn)
+                    if not fn.endswith(".tmp") and fntime(path) >= t:
+                        yield path
+
+    def types(self):
+        p = os.path.join(workdir, "store")
+        if not os.path.exists(p):
+            return []
+        return os.listdir(p)
+
+    def walk(self, otype):
+        store = os.path.join(workdir, "store")
+        for rootdir, _dirs, files in os.walk(os.path.join(store, otype)):
+            for fn in files:
+                if fn.endswith(".tmp"):
+                    continue
+                yield os.path.relpath(os.path.join(rootdir, fn), store)
+
+    def write(self, path, data):
+        cdir(os.path.join(workdir, "store", path))
+        self.replace(path, data)
+
+    def writemany(self, items):
+        for path, data in items:
+            self.write(path, data)
+
+class Index(Object):
+
+    span = 60 * 60
+
+    def __init__(self, otype):
+        super().__init__()
+        self.otype = otype
+        self.buckets = {}
+        self.fields = {}
+        self.ino = None
+        self.keys = []
+        self.latest = {}
+        self.offset = 0
+        self.order = []
+        self.recorded = {}
+        self.words = {}
+
+    def add(self, entry):
+        path = entry["path"]
+        uid = path.split(os.sep)[1]
+        t = entry["time"]
+        key = int(t // self.span)
+        if key not in self.buckets:
+            self.buckets[key] = []
+            bisect.insort(self.keys, key)
+        bucket = self.buckets[key]
+        if bucket and bucket[-1][0] > t:
+            bisect.insort(bucket, (t, path))
+        else:
+            bucket.append((t, path))
+        if uid in self.latest and self.latest[uid][0] > t:
+            return
+        self.latest[uid] = (t, path, entry.get("deleted", False))
+        self.order = []
+        if "fields" in entry:
+            self.recorded[uid] = entry["fields"]
+        elif uid in self.recorded:
+            del self.recorded[uid]
+        for key in self.fields:
+            self.put(key, uid)
+        for key in self.words:
+            self.tokenize(key, uid)
+
+    def build(self, key):
+        if key not in self.fields:
+            self.fields[key] = ({}, {}, [])
+            for uid in self.latest:
+                self.put(key, uid)
+        return self.fields[key]
+
+    def contains(self, key, txt):
+        vals, _uids, _keys = self.build(key)
+        res = set()
+        for value, uids in vals.items():
+            if txt in value:
+                res |= uids
+        return res
+
+    def entries(self, timed=None):
+        if timed:
+            res = []
+            for _t, path in self.versions(timed):
+                entry = self.latest.get(path.split(os.sep)[1], None)
+                if entry and entry[1] == path:
+                    res.append(entry)
+            return res
+        if not self.order and self.latest:
+            self.order = sorted(self.latest.values())
+        return self.order
+
+    def match(self, key, txt):
+        if key not in self.words:
+            self.words[key] = ({}, {}, [])
+            for uid in self.latest:
+                self.tokenize(key, uid)
+        tokens, _uids, order = self.words[key]
+        if not order:
+            order.extend(sorted(tokens))
+        res = None
+        for word in words(txt):
+            found = set()
+            for token in order[bisect.bisect_left(order, word):]:
+                if not token.startswith(word):
+                    break
+                found |= tokens[token]
+            res = found if res is None else res & found
+            if not res:
+                break
+        return res or set()
+
+    def put(self, key, uid):
+        vals, uids, keys = self.fields[key]
+        if uid in uids:
+            vals[uids[uid]].discard(uid)
+        value = self.value(key, uid)
+        uids[uid] = value
+        if value not in vals:
+            vals[value] = set()
+            keys.clear()
+        vals[value].add(uid)
+
+    def refresh(self):
+        fn = os.path.join(workdir, "index", self.otype, "log")
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return
+        if st.st_ino != self.ino or st.st_size < self.offset:
+            self.__init__(self.otype)
+            self.ino = st.st_ino
+        if st.st_size == self.offset:
+            return
+        with open(fn, "rb") as ifile:
+            ifile.seek(self.offset)
+            for line in ifile:
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                self.add(json.loads(line))
+
+    def select(self, key, value, kind="exact"):
+        vals, uids, keys = self.build(key)
+        if kind != "prefix":
+            return set(vals.get(value, ()))
+        if not keys:
+            keys.extend(sorted(vals))
+        res = set()
+        for k in keys[bisect.bisect_left(keys, value):]:
+            if not k.startswith(value):
+                break
+            res |= vals[k]
+        return res
+
+    def tokenize(self, key, uid):
+        tokens, uids, order = self.words[key]
+        for token in uids.get(uid, ()):
+            tokens[token].discard(uid)
+        uids[uid] = set(words(self.value(key, uid)))
+        for token in uids[uid]:
+            if token not in tokens:
+                tokens[token] = set()
+                order.clear()
+            tokens[token].add(uid)
+
+    def value(self, key, uid):
+        fields = self.recorded.get(uid, {})
+        if key in fields:
+            return fields[key]
+        return str(get(hook(self.latest[uid][1]), key))
+
+    def versions(self, timed=None):
+        lo = 0
+        hi = len(self.keys)
+        if timed and get(timed, "from"):
+            lo = bisect.bisect_left(self.keys, int(timed["from"] // self.span))
+        if timed and get(timed, "to"):
+            hi = bisect.bisect_right(self.keys, int(timed["to"] // self.span))
+        res = []
+        for key in self.keys[lo:hi]:
+            res.extend(self.buckets[key])
+        if timed:
+            return [v for v in res if intime(v[0], timed)]
+        return res
+
+class Json(Object):
+
+    magic = b""
+
+    def decode(self, data, hook=None):
+        return json.loads(data, object_hook=hook)
+
+    def encode(self, o):
+        return bytes(json.dumps(o, default=default), "utf-8")
+
+class Marshal(Object):
+
+    magic = b"\x00ZBM1"
+
+    def decode(self, data, hook=None):
+        v, nested = marshal.loads(data[len(self.magic):])
+        if hook and nested:
+            return hookall(v, hook)
+        if hook and isinstance(v, dict):
+            return hook(v)
+        return v
+
+    def encode(self, o):
+        nested = []
+        v = plain(o, nested)
+        return self.magic + marshal.dumps((v, len(nested) > 1), 4)
+
+class Record(Object):
+
+    __slots__ = ()
+    __fields__ = {}
+
+    _vars = Object.__dict__["__dict__"]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = {}
+        for c in cls.__mro__[::-1]:
+            slots = c.__dict__.get("__slots__", ())
+            for k in [slots] if isinstance(slots, str) else slots:
+                if k not in ("__dict__", "__weakref__", "_stamp"):
+                    fields[k] = c.__dict__[k]
+        cls.__fields__ = fields
+
+    def __dir__(self):
+        return sorted(set(object.__dir__(self)) | set(Record._vars.__get__(self)))
+
+    @property
+    def __dict__(self):
+        return Fields(self)
+
+class Watch(Object):
+
+    def __init__(self, otype, func=None, selector=None):
+        super().__init__()
+        self.func = func
+        self.otype = otype
+        self.queue = queue.Queue()
+        self.selector = selector
+
+    def cancel(self):
+        unwatch(self)
+
+    def put(self, o):
+        if self.selector and not search(o, self.selector):
+            return
+        if self.func:
+            self.func(o)
+        else:
+            self.queue.put(o)
+
+def add_index(otype, key, kind="exact"):
+    if otype not in indexed:
+        indexed[otype] = {}
+    indexed[otype][key] = kind
+
+async def afind(otype, selector=None, index=None, timed=None, batch=64):
+    gen = find(otype, selector, index, timed)
+    while True:
+        objs = await offload(chunk, gen, batch)
+        for o in objs:
+            yield o
+        if len(objs) < batch:
+            break
+
+async def alast(o):
+    return await offload(last, o)
+
 def all(otype, selector=None, index=None, timed=None):
     nr = -1
     if selector is None:
         selector = {}
-    for fn in objs(otype, timed):
-        o = hook(fn)
+    for _t, fn, d in entries(otype, timed, selector):
+        if d:
+            continue
+        o = current(fn)
         if selector and not search(o, selector):
             continue
         if "_deleted" in o and o._deleted:
@@ -101,12 +625,19 @@ def all(otype, selector=None, index=None, timed=None):
             continue
         yield o
 
+async def aload(o, path):
+    return await offload(load, o, path)
+
+async def asave(o, stime=None):
+    return await offload(save, o, stime)
 
 def cdir(path):
     if os.path.exists(path):
         return
     res = ""
     path2, _fn = os.path.split(path)
+    if os.path.isdir(path2):
+        return
     for p in path2.split(os.sep):
         res += "%s%s" % (p, os.sep)
         padje = os.path.abspath(os.path.normpath(res))
@@ -116,7 +647,128 @@ def cdir(path):
         except (IsADirectoryError, NotADirectoryError, FileExistsError):
             pass
 
+def changes(otype):
+    fn = os.path.join(workdir, "index", otype, "log")
+    res = []
+    with feedlock:
+        ino, offset = feeds.get(otype, (None, 0))
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return res
+        if ino is None:
+            ino = st.st_ino
+        elif st.st_ino != ino or st.st_size < offset:
+            feeds[otype] = (st.st_ino, st.st_size)
+            return res
+        with open(fn, "rb") as ifile:
+            ifile.seek(offset)
+            for line in ifile:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                res.append(json.loads(line))
+        feeds[otype] = (ino, offset)
+    return res
+
+def chunk(gen, nr):
+    return list(itertools.islice(gen, nr))
+
+def compact(otype, keep=1, retention=None):
+    assert workdir
+    keep = max(int(keep), 1)
+    i = get_index(otype)
+    with indexlock:
+        latest = dict(i.latest)
+        versions = i.versions()
+    byuid = {}
+    for t, path in versions:
+        byuid.setdefault(path.split(os.sep)[1], []).append((t, path))
+    now = time.time()
+    removed = set()
+    res = Object()
+    res.objects = 0
+    for uid, vs in byuid.items():
+        vs.sort()
+        _t, _path, d = latest.get(uid, (0, "", False))
+        if d and retention is not None and vs[-1][0] < now - retention:
+            removed.update([p for _t, p in vs])
+            res.objects += 1
+        elif len(vs) > keep:
+            removed.update([p for _t, p in vs[:-keep]])
+    res.versions = len(removed)
+    res.bytes = res.inodes = 0
+    if not removed:
+        return res
+    ipath = os.path.join(workdir, "index", otype, "log")
+    with open(ipath, "rb") as ifile:
+        lines = ifile.readlines()
+    size = sum([len(line) for line in lines if line.endswith(b"\n")])
+    tmp = "%s.%s" % (ipath, os.getpid())
+    with open(tmp, "wb") as ifile:
+        for line in lines:
+            if not line.endswith(b"\n"):
+                break
+            if json.loads(line)["path"] not in removed:
+                ifile.write(line)
+        with typelock(otype), loglock(otype):
+            with open(ipath, "rb") as tfile:
+                tfile.seek(size)
+                ifile.write(tfile.read())
+                ifile.flush()
+            os.replace(tmp, ipath)
+    if lastpath(otype) in removed:
+        os.remove(os.path.join(workdir, "index", otype, "last"))
+    for path in removed:
+        cache.clear(path)
+    res.bytes, res.inodes = engine.remove(removed)
+    return res
+
+def convert(name, batch=500):
+    assert workdir
+    old = engine
+    new = get_cls(engines.get(name, name))()
+    otypes = sorted(old.types())
+    nr = 0
+    with contextlib.ExitStack() as stack:
+        for otype in otypes:
+            stack.enter_context(typelock(otype))
+        for otype in otypes:
+            nr += copy(old, new, otype, batch)
+        set_engine(name)
+    for otype in sorted(set(old.types()) - set(otypes)):
+        with typelock(otype):
+            nr += copy(old, new, otype, batch)
+    cache.clear()
+    return nr
+
+def copy(old, new, otype, batch=500):
+    paths = names(otype)
+    nr = 0
+    for x in range(0, len(paths), batch):
+        items = []
+        for path in paths[x:x+batch]:
+            try:
+                items.append((path, old.read(path)))
+            except OSError as ex:
+                print(path, ex)
+        new.writemany(items)
+        nr += len(items)
+    return nr
+
+def current(fn):
+    try:
+        return hook(fn)
+    except FileNotFoundError:
+        otype, uid = fn.split(os.sep)[:2]
+        entry = get_index(otype).latest.get(uid, None)
+        if not entry or entry[1] == fn:
+            raise
+        return hook(entry[1])
+
 def default(o):
+    if isinstance(o, Record):
+        return dict(vars(o))
     if isinstance(o, Object):
         return vars(o)
     if isinstance(o, dict):
@@ -128,12 +780,30 @@ def default(o):
     return repr(o)
 
 def deleted(otype):
-    for fn in objs(otype):
-        o = hook(fn)
+    for _t, fn, d in entries(otype):
+        if not d:
+            continue
+        o = current(fn)
         if "_deleted" not in o or not o._deleted:
             continue
         yield o
 
+def dup(v):
+    if isinstance(v, Object):
+        o = type(v).__new__(type(v))
+        o._stamp = getattr(v, "_stamp", None)
+        for k, vv in v.__dict__.items():
+            o.__dict__[k] = dup(vv)
+        return o
+    if isinstance(v, dict):
+        return {k: dup(vv) for k, vv in v.items()}
+    if isinstance(v, list):
+        return [dup(vv) for vv in v]
+    return v
+
+def dumps(o, name=None):
+    return codecs[name or codec].encode(o)
+
 def edit(o, setter, skip=False):
     try:
         setter = vars(setter)
@@ -154,6 +824,45 @@ def edit(o, setter, skip=False):
             o[key] = value
     return count
 
+def entries(otype, timed=None, selector=None):
+    if not otype:
+        return []
+    assert workdir
+    i = get_index(otype)
+    keys = indexed.get(otype, {})
+    uids = None
+    for k, v in items(selector or {}):
+        if keys.get(k, "text") == "text":
+            continue
+        with indexlock:
+            found = i.contains(k, str(v))
+        uids = found if uids is None else uids & found
+    if uids is None:
+        return i.entries(timed)
+    res = sorted([i.latest[uid] for uid in uids])
+    if not timed:
+        return res
+    return [e for e in res if intime(e[0], timed)]
+
+def export(fn, otypes=None, timed=None):
+    assert workdir
+    nr = 0
+    with gzip.open(fn + ".tmp", "wt", encoding="utf-8") as zfile:
+        for otype in otypes or engine.types():
+            for t, path in get_index(otype).versions(timed):
+                try:
+                    data = engine.read(path)
+                    tree = get_codec(data).decode(data)
+                except (OSError, ValueError, EOFError, TypeError) as ex:
+                    print(path, ex)
+                    continue
+                deleted = bool(isinstance(tree, dict) and tree.get("_deleted"))
+                zfile.write(json.dumps({"path": path, "time": t, "deleted": deleted, "object": tree},
+                                       default=default) + "\n")
+                nr += 1
+    os.replace(fn + ".tmp", fn)
+    return nr
+
 def fntime(daystr):
     daystr = daystr.replace("_", ":")
     datestr = " ".join(daystr.split(os.sep)[-2:])
@@ -162,10 +871,13 @@ def fntime(daystr):
     except ValueError:
         rest = ""
     try:
-        t = time.mktime(time.strptime(datestr, "%Y-%m-%d %H:%M:%S"))
+        if len(datestr) == 19 and datestr[4] == "-" and datestr[13] == ":":
+            t = hourtime(datestr[:13]) + int(datestr[14:16]) * 60 + int(datestr[17:])
+        else:
+            t = time.mktime(time.strptime(datestr, "%Y-%m-%d %H:%M:%S"))
         if rest:
             t += float("." + rest)
-    except ValueError:
+    except (ValueError, OverflowError):
         t = 0
     return t
 
@@ -173,8 +885,10 @@ def find(otype, selector=None, index=None, timed=None):
     nr = -1
     if selector is None:
         selector = {}
-    for fn in objs(otype, timed):
-        o = hook(fn)
+    for _t, fn, d in entries(otype, timed, selector):
+        if d:
+            continue
+        o = current(fn)
         if selector and not search(o, selector):
             continue
         if "_deleted" in o and o._deleted:
@@ -186,8 +900,10 @@ def find(otype, selector=None, index=None, timed=None):
 
 def find_event(e):
     nr = -1
-    for fn in objs(e.otype, e.timed):
-        o = hook(fn)
+    for _t, fn, d in entries(e.otype, e.timed, e.gets):
+        if d:
+            continue
+        o = current(fn)
         if e.gets and not search(o, e.gets):
             continue
         if "_deleted" in o and o._deleted:
@@ -223,6 +939,13 @@ def format(o, keylist=None, pure=False, skip=None):
             txt += "%s=%s%s" % (k, v, " ")
     return txt.strip()
 
+def fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def get(o, k, d=None):
     try:
         res = o.get(k, d)
@@ -241,6 +964,31 @@ def get_cls(name):
         mod = importlib.import_module(modname)
     return getattr(mod, clsname)
 
+def get_codec(data):
+    for c in codecs.values():
+        if c.magic and data.startswith(c.magic):
+            return c
+    return codecs["json"]
+
+def get_executor():
+    global executor
+    with lockslock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(workers, "store")
+    return executor
+
+def get_index(otype):
+    if otype not in indexes and not os.path.exists(os.path.join(workdir, "index", otype, "log")):
+        with typelock(otype):
+            if not os.path.exists(os.path.join(workdir, "index", otype, "log")):
+                reindex(otype)
+    with indexlock:
+        i = indexes.get(otype, None)
+        if i is None:
+            i = indexes[otype] = Index(otype)
+        i.refresh()
+    return i
+
 def get_name(o):
     t = type(o)
     if t == types.ModuleType:
@@ -266,6 +1014,30 @@ def get_type(o):
             pass
     return str(type(o)).split()[-1][1:-2]
 
+def grep(otype, txt, timed=None):
+    if "text" not in indexed.get(otype, {}).values():
+        want = words(txt)
+        for o in find(otype, None, None, timed):
+            tokens = words(" ".join([str(v) for v in values(o)]))
+            missing = [w for w in want if not any([t.startswith(w) for t in tokens])]
+            if want and not missing:
+                yield o
+        return
+    i = get_index(otype)
+    uids = set()
+    with indexlock:
+        for key, kind in indexed.get(otype, {}).items():
+            if kind == "text":
+                uids |= i.match(key, txt)
+    for t, fn, d in sorted([i.latest[uid] for uid in uids]):
+        if d or (timed and not intime(t, timed)):
+            continue
+        yield current(fn)
+
+@functools.lru_cache(maxsize=1024)
+def hourtime(hourstr):
+    return time.mktime(time.strptime(hourstr, "%Y-%m-%d %H"))
+
 def hook(fn):
     if fn.count(os.sep) > 3:
         oname = fn.split(os.sep)[-4:]
@@ -275,20 +1047,37 @@ def hook(fn):
     if not t:
         raise ENOFILENAME(fn)
     o = get_cls(t)()
-    load(o, fn)
+    load(o, os.sep.join(oname))
     return o
 
+def hookall(v, hook):
+    if isinstance(v, dict):
+        return hook({k: hookall(vv, hook) for k, vv in v.items()})
+    if isinstance(v, list):
+        return [hookall(vv, hook) for vv in v]
+    return v
+
 def hooked(d):
-    if "stamp" in dir(d):
+    if "stamp" in d:
         t = d["stamp"].split(os.sep)[0]
         if not t:
             return d
-        o = get_cls(t)()
+        try:
+            o = get_cls(t)()
+        except (ENOCLASS, ImportError, AttributeError, TypeError):
+            return d
         update(o, d)
-        del o["stamp"]
+        o.__stamp__ = o.__dict__.pop("stamp")
         return o
     return d
 
+def intime(t, timed):
+    if "from" in timed and timed["from"] and t < timed["from"]:
+        return False
+    if get(timed, "to") and t > timed["to"]:
+        return False
+    return True
+
 def items(o):
     try:
         return o.items()
@@ -308,36 +1097,54 @@ def last(o):
         o.__stamp__ = path
 
 def lasttype(otype):
-    fns = objs(otype)
-    if fns:
-        return hook(fns[-1])
+    fn = lastpath(otype)
+    if fn:
+        return hook(fn)
 
-def lastfn(otype):
-    fns = objs(otype)
-    if fns:
-        fn = fns[-1]
+def lastfn(otype, uid=None):
+    fn = lastpath(otype, uid)
+    if fn:
         return (fn, hook(fn))
     return (None, None)
 
+def lastpath(otype, uid=None):
+    if uid:
+        entry = get_index(otype).latest.get(uid, None)
+        return entry and entry[1]
+    try:
+        with open(os.path.join(workdir, "index", otype, "last"), "r") as lfile:
+            fn = lfile.read()
+    except FileNotFoundError:
+        fn = ""
+    if fn and os.sep in fn:
+        return fn
+    fns = entries(otype)
+    if fns:
+        return fns[-1][1]
+
 def load(o, path):
     assert path
     assert workdir
     o.__stamp__ = path
-    lpath = os.path.join(workdir, "store", path)
-    cdir(lpath)
-    with open(lpath, "r") as ofile:
+    v = cache.fetch(path)
+    if v is None:
+        data = engine.read(path)
         try:
-            v = json.load(ofile, object_hook=hooked)
-        except json.decoder.JSONDecodeError as ex:
+            v = loads(data)
+        except (ValueError, EOFError, TypeError) as ex:
             print(path, ex)
             return
-        if v:
-            if isinstance(v, Object):
-                o.__dict__.update(vars(v))
-            else:
-                o.__dict__.update(v)
+        cache.put(path, dup(v), len(data))
+    if v:
+        if isinstance(v, Object):
+            o.__dict__.update(vars(v))
+        else:
+            o.__dict__.update(v)
     unstamp(o)
 
+def loads(data, hook=hooked):
+    return get_codec(data).decode(data, hook)
+
 def locked(l):
     def lockeddec(func, *args, **kwargs):
         def lockedfunc(*args, **kwargs):
@@ -352,57 +1159,271 @@ def locked(l):
         return lockedfunc
     return lockeddec
 
+@contextlib.contextmanager
+def loglock(otype):
+    fn = os.path.join(workdir, "index", otype, "lock")
+    cdir(fn)
+    fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        os.close(fd)
+
+def lookup(otype, key, value, timed=None):
+    i = get_index(otype)
+    with indexlock:
+        uids = i.select(key, str(value), indexed.get(otype, {}).get(key, "exact"))
+    for t, fn, d in sorted([i.latest[uid] for uid in uids]):
+        if d or (timed and not intime(t, timed)):
+            continue
+        o = current(fn)
+        if "_deleted" in o and o._deleted:
+            continue
+        yield o
+
+def migrate(otype, name="json"):
+    assert workdir
+    new = codecs[name]
+    nr = 0
+    for path in names(otype):
+        data = engine.read(path)
+        old = get_codec(data)
+        if old is new:
+            continue
+        try:
+            v = old.decode(data)
+        except (ValueError, EOFError, TypeError) as ex:
+            print(path, ex)
+            continue
+        with typelock(otype):
+            engine.replace(path, new.encode(v))
+        cache.clear(path)
+        nr += 1
+    return nr
+
 def names(name, timed=None):
     if not name:
         return []
     assert workdir
-    p = os.path.join(workdir, "store", name) + os.sep
-    res = []
-    for rootdir, _dirs, files in os.walk(p, topdown=False):
-        for fn in files:
-            fnn = os.path.join(rootdir, fn).split(os.path.join(workdir, "store"))[-1]
-            ftime = fntime(fnn)
-            if timed and "from" in timed and timed["from"] and ftime < timed["from"]:
-                continue
-            if timed and timed.to and ftime > timed.to:
-                continue
-            res.append(os.sep.join(fnn.split(os.sep)[1:]))
-    return sorted(res, key=fntime)
+    return [p for _t, p in get_index(name).versions(timed)]
+
+def notify(otype):
+    for entry in changes(otype):
+        try:
+            o = hook(entry["path"])
+        except (OSError, ValueError, EOFError, TypeError, ENOCLASS, ENOFILENAME) as ex:
+            print(entry["path"], ex)
+            continue
+        for w in list(watches.get(otype, ())):
+            try:
+                w.put(o)
+            except Exception as ex:
+                print("%s %s" % (w.func, ex))
 
 def objs(name, timed=None):
-    if not name:
-        return []
+    return [p for _t, p, _d in entries(name, timed)]
+
+def offload(func, *args):
+    return asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+
+def plain(o, nested=None):
+    if isinstance(o, Record):
+        o = dict(vars(o))
+    elif isinstance(o, Object):
+        o = vars(o)
+    if isinstance(o, dict):
+        if nested is not None and "stamp" in o:
+            nested.append(o)
+        return {k if type(k) is str else str(k): v if type(v) in scalars else plain(v, nested)
+                for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [v if type(v) in scalars else plain(v, nested) for v in o]
+    if type(o) in scalars:
+        return o
+    return repr(o)
+
+def own():
+    global owner
+    if owner is not None and owner[0] == workdir:
+        return True
+    cdir(os.path.join(workdir, ""))
+    fd = os.open(os.path.join(workdir, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    owner = (workdir, fd)
+    return True
+
+def recover(tail=64):
     assert workdir
-    p = os.path.join(workdir, "store", name) + os.sep
-    res = []
-    d = ""
-    for rootdir, dirs, _files in os.walk(p, topdown=False):
-        if dirs:
-            d = sorted(dirs)[-1]
-            if d.count("-") == 2:
-                dd = os.path.join(rootdir, d)
-                fls = sorted(os.listdir(dd))
-                if fls:
-                    p = os.path.join(dd, fls[-1])
-                    if timed and "from" in timed and timed["from"] and fntime(p) < timed["from"]:
-                        continue
-                    if timed and timed.to and fntime(p) > timed.to:
-                        continue
-                    res.append(p)
-    return sorted(res, key=fntime)
+    start = time.time()
+    res = Object()
+    res.checked = res.dropped = res.orphans = res.temps = res.torn = res.types = 0
+    res.skipped = not own()
+    res.seconds = 0.0
+    if res.skipped:
+        return res
+    p = os.path.join(workdir, "index")
+    for otype in os.listdir(p) if os.path.exists(p) else []:
+        if not os.path.exists(os.path.join(p, otype, "log")):
+            continue
+        with typelock(otype):
+            checked, dropped, temps, torn, orphans = repair(otype, tail)
+        res.checked += checked
+        res.dropped += dropped
+        res.orphans += orphans
+        res.temps += temps
+        res.torn += torn
+        res.types += 1
+    res.seconds = round(time.time() - start, 6)
+    return res
 
 def register(o, k, v):
     o[k] = v
 
-@locked(savelock)
+def reindex(otype):
+    assert workdir
+    res = []
+    latest = {}
+    for path in engine.walk(otype):
+        entry = {"path": path, "time": fntime(path), "deleted": False}
+        res.append(entry)
+        uid = path.split(os.sep)[1]
+        if uid not in latest or latest[uid]["time"] < entry["time"]:
+            latest[uid] = entry
+    if not res:
+        return 0
+    for entry in latest.values():
+        try:
+            entry["deleted"] = bool(loads(engine.read(entry["path"]), None).get("_deleted", False))
+        except (ValueError, EOFError, TypeError, AttributeError):
+            pass
+    ipath = os.path.join(workdir, "index", otype, "log")
+    cdir(ipath)
+    with open(ipath + ".tmp", "w") as ifile:
+        for entry in sorted(res, key=lambda x: x["time"]):
+            ifile.write(json.dumps(entry) + "\n")
+    os.replace(ipath + ".tmp", ipath)
+    return len(res)
+
+def repair(otype, tail=64):
+    ipath = os.path.join(workdir, "index", otype, "log")
+    with loglock(otype), open(ipath, "rb+") as ifile:
+        size = ifile.seek(0, 2)
+        pos = max(0, size - tail * 512)
+        ifile.seek(pos)
+        chunk = ifile.read()
+        if pos:
+            skip = chunk.find(b"\n") + 1
+            pos += skip
+            chunk = chunk[skip:]
+        lines = chunk.split(b"\n")
+        torn = 1 if lines.pop() else 0
+        keep = lines[:-tail]
+        good = []
+        bad = []
+        dropped = []
+        paths = []
+        for line in lines[-tail:]:
+            path = None
+            try:
+                path = json.loads(line)["path"]
+                paths.append(path)
+                loads(engine.read(path), None)
+            except (OSError, ValueError, KeyError, EOFError, TypeError):
+                bad.append(line)
+                if path:
+                    dropped.append(path)
+                continue
+            good.append(line)
+        temps = engine.recover(otype, paths) if paths else 0
+        logged = set(paths)
+        for line in keep:
+            try:
+                logged.add(json.loads(line)["path"])
+            except (ValueError, KeyError, TypeError):
+                continue
+        times = [fntime(p) for p in paths if p not in dropped]
+        orphans = []
+        for path in sorted(engine.since(otype, min(times) if (pos or keep) and times else 0), key=fntime):
+            t = fntime(path)
+            if path in logged or time.time() - t < engine.grace:
+                continue
+            try:
+                deleted = bool(loads(engine.read(path), None).get("_deleted", False))
+            except (OSError, ValueError, EOFError, TypeError, AttributeError):
+                continue
+            orphans.append(bytes(json.dumps({"path": path, "time": t, "deleted": deleted}), "utf-8"))
+        if not bad and not torn and not orphans:
+            return len(lines[-tail:]), 0, temps, 0, 0
+        ifile.seek(pos)
+        ifile.truncate()
+        ifile.write(b"".join([line + b"\n" for line in keep + good + orphans]))
+        ifile.flush()
+        os.fsync(ifile.fileno())
+    engine.remove(dropped)
+    for path in dropped:
+        cache.clear(path)
+    try:
+        os.remove(os.path.join(workdir, "index", otype, "last"))
+    except FileNotFoundError:
+        pass
+    with indexlock:
+        indexes.pop(otype, None)
+    return len(lines[-tail:]), len(bad), temps, torn, len(orphans)
+
+def restore(fn, otypes=None, timed=None, batch=500):
+    assert workdir
+    nr = 0
+    known = {}
+    pending = {}
+    with gzip.open(fn, "rt", encoding="utf-8") as zfile:
+        for line in zfile:
+            v = json.loads(line)
+            path = v["path"]
+            otype = path.split(os.sep)[0]
+            if otypes and otype not in otypes and otype.split(".")[-1].lower() not in otypes:
+                continue
+            if timed and not intime(v["time"], timed):
+                continue
+            if otype not in known:
+                known[otype] = set(names(otype))
+            if path in known[otype]:
+                continue
+            entry = {"path": path, "time": v["time"], "deleted": v["deleted"]}
+            if otype in indexed:
+                entry["fields"] = {k: str(get(v["object"], k)) for k in indexed[otype]}
+            pending.setdefault(otype, []).append((dumps(v["object"]), entry, True))
+            known[otype].add(path)
+            nr += 1
+            if len(pending[otype]) >= batch:
+                with typelock(otype):
+                    write(otype, pending.pop(otype))
+    for otype, items in pending.items():
+        with typelock(otype):
+            write(otype, items)
+    for otype in known:
+        with indexlock:
+            indexes.pop(otype, None)
+        if otype in watches:
+            notify(otype)
+    cache.clear()
+    return nr
+
 def save(o, stime=None):
     assert workdir
     if stime:
         o.__stamp__ = os.path.join(get_type(o), str(uuid.uuid4()),
                                    stime + "." + str(random.randint(0, 100000)))
+        t = fntime(o.__stamp__)
     else:
-        timestamp = str(datetime.datetime.now()).split()
-        if getattr(o, "__stamp__", None):
+        now = datetime.datetime.now()
+        t = now.timestamp()
+        timestamp = str(now).split()
+        if getattr(o, "_stamp", None):
             try:
                 spl = o.__stamp__.split(os.sep)
                 spl[-2] = timestamp[0]
@@ -410,13 +1431,23 @@ def save(o, stime=None):
                 o.__stamp__ = os.sep.join(spl)
             except AttributeError:
                 pass
-        if not getattr(o, "__stamp__", None):
+        if not getattr(o, "_stamp", None):
             o.__stamp__ = os.path.join(get_type(o), str(uuid.uuid4()), os.sep.join(timestamp))
-    opath = os.path.join(workdir, "store", o.__stamp__)
-    cdir(opath)
-    with open(opath, "w") as ofile:
-        json.dump(stamp(o), ofile, default=default)
-    os.chmod(opath, 0o444)
+    otype = o.__stamp__.split(os.sep)[0]
+    data = dumps(stamp(o))
+    entry = {"path": o.__stamp__, "time": t, "deleted": bool(get(o, "_deleted"))}
+    if otype in indexed:
+        entry["fields"] = {k: str(get(o, k)) for k in indexed[otype]}
+    if group:
+        with lockslock:
+            if otype not in commits:
+                commits[otype] = Commit(otype)
+        commits[otype].commit((data, entry, stime))
+    else:
+        with typelock(otype):
+            write(otype, [(data, entry, stime)])
+    if otype in watches:
+        notify(otype)
     return o.__stamp__
 
 def scan(o, txt):
@@ -435,31 +1466,78 @@ def search(o, s):
         ok = True
     return ok
 
+def set_engine(name=""):
+    global engine
+    assert workdir
+    fn = os.path.join(workdir, "engine")
+    if name:
+        cdir(fn)
+        with open(fn, "w") as efile:
+            efile.write(name)
+    elif os.path.exists(fn):
+        with open(fn, "r") as efile:
+            name = efile.read().strip()
+    engine = get_cls(engines.get(name or "files", name))()
+    return engine
+
 def stamp(o):
-    for k in xdir(o):
-        oo = getattr(o, k, None)
-        if isinstance(oo, Object):
-            stamp(oo)
-            oo.__dict__["stamp"] = oo.__stamp__
-            o[k] = oo
-        else:
-            continue
-    o.__dict__["stamp"] = o.__stamp__
+    if isinstance(o, Object):
+        for v in o.__dict__.values():
+            if type(v) not in scalars:
+                stamp(v)
+        o.__dict__["stamp"] = o.__stamp__
+    elif isinstance(o, dict):
+        for v in o.values():
+            if type(v) not in scalars:
+                stamp(v)
+    elif isinstance(o, (list, tuple)):
+        for v in o:
+            if type(v) not in scalars:
+                stamp(v)
     return o
 
+def tail():
+    global poller
+    while True:
+        with feedlock:
+            if not watches:
+                poller = None
+                return
+            otypes = list(watches)
+        for otype in otypes:
+            notify(otype)
+        time.sleep(interval)
+
+def typelock(otype):
+    with lockslock:
+        if otype not in locks:
+            locks[otype] = _thread.allocate_lock()
+        return locks[otype]
+
 def unstamp(o):
-    for k in xdir(o):
-        oo = getattr(o, k, None)
-        if isinstance(oo, Object):
-            del oo.__dict__["stamp"]
-        else:
-            continue
-    try:
-        del o.__dict__["stamp"]
-    except KeyError:
-        pass
+    if isinstance(o, Object):
+        o.__dict__.pop("stamp", None)
+        for v in o.__dict__.values():
+            if type(v) not in scalars:
+                unstamp(v)
+    elif isinstance(o, dict):
+        for v in o.values():
+            if type(v) not in scalars:
+                unstamp(v)
+    elif isinstance(o, (list, tuple)):
+        for v in o:
+            if type(v) not in scalars:
+                unstamp(v)
     return o
 
+def unwatch(w):
+    with feedlock:
+        if w in watches.get(w.otype, ()):
+            watches[w.otype].remove(w)
+        if not watches.get(w.otype, True):
+            del watches[w.otype]
+            feeds.pop(w.otype, None)
+
 def update(o, d):
     if isinstance(d, Object):
         return o.__dict__.update(vars(d))
@@ -471,6 +1549,47 @@ def values(o):
     except (TypeError, AttributeError):
         return o.__dict__.values()
 
+def watch(otype, func=None, selector=None):
+    global poller
+    assert workdir
+    w = Watch(otype, func, selector)
+    with feedlock:
+        if otype not in feeds:
+            try:
+                st = os.stat(os.path.join(workdir, "index", otype, "log"))
+                feeds[otype] = (st.st_ino, st.st_size)
+            except FileNotFoundError:
+                feeds[otype] = (None, 0)
+        watches.setdefault(otype, []).append(w)
+        if poller is None:
+            poller = threading.Thread(target=tail, name="tail", daemon=True)
+            poller.start()
+    return w
+
+def words(txt):
+    return re.findall(r"\w+", txt.lower())
+
+def write(otype, items, sync=False):
+    ipath = os.path.join(workdir, "index", otype, "log")
+    if not os.path.exists(ipath):
+        reindex(otype)
+    engine.writemany([(entry["path"], data) for data, entry, _stime in items])
+    with loglock(otype), open(ipath, "a") as ifile:
+        ifile.write("".join([json.dumps(entry) + "\n" for _data, entry, _stime in items]))
+        if sync:
+            ifile.flush()
+            os.fsync(ifile.fileno())
+    if sync:
+        engine.flush([entry["path"] for _data, entry, _stime in items])
+    pointer = lastpath(otype) if [x for x in items if x[2]] else ""
+    for _data, entry, stime in items[::-1]:
+        if not stime or entry["time"] >= fntime(pointer or ""):
+            lpath = os.path.join(workdir, "index", otype, "last")
+            with open("%s.%s" % (lpath, os.getpid()), "w") as lfile:
+                lfile.write(entry["path"])
+            os.replace("%s.%s" % (lpath, os.getpid()), lpath)
+            break
+
 def xdir(o, skip=None):
     res = []
     for k in dir(o):
@@ -478,3 +1597,8 @@ def xdir(o, skip=None):
             continue
         res.append(k)
     return res
+
+cache = Cache()
+codecs["json"] = Json()
+codecs["marshal"] = Marshal()
+engine = Files()